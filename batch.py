@@ -0,0 +1,319 @@
+# batch.py
+"""
+Generate charts in bulk from a JSONL file of jobs.
+
+Each line is a job such as:
+
+    {"id": "visits", "dataset": "sample.csv", "prompt": "Monthly visits per site",
+     "backend": "vega-lite", "output": "dashboards/visits.html"}
+
+`backend` is "vega-lite" (default) or "chartjs"; `output` defaults to
+output-batch-<backend>.html; `id` defaults to the line number. A line
+that is not valid JSON, names an unknown backend or lacks a `dataset` or
+`prompt` is reported as a failed job in its result line while the other
+jobs run. Jobs run
+concurrently up to --concurrency. Each dataset is loaded and profiled once
+and shared by every job that uses it. One result line per job (timings,
+status, error) is appended to the --results file as jobs finish.
+
+Usage:
+    python batch.py jobs.jsonl [--results results.jsonl] [--concurrency 8] [--timeout 60]
+"""
+import argparse
+import asyncio
+import html
+import json
+import os
+import time
+
+from dataset_cache import dataset_profile, read_csv_cached
+from http_fetch import fetch_csv
+from llm_cache import async_cached_chat_completion, print_cache_stats
+from metrics import JSON_PARSE_FAILURES, TIME_TO_CHART_SECONDS, write_output
+from openai_client import get_async_client
+from prompt_layout import build_messages
+from prompt_summary import memoized_context
+from semantic_types import apply_field_types, describe_field_types, detect_field_types
+from structured_output import json_mode_request, parse_structured, structured_request, vega_lite_schema
+from utils import (
+    dataframe_to_records,
+    extract_json,
+    infer_csv_structure,
+    optimize_dataframe,
+)
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = float(os.getenv("VIZ_LLM_TIMEOUT", 60))
+BACKENDS = ("vega-lite", "chartjs")
+REQUIRED_KEYS = ("dataset", "prompt")
+
+VEGA_LITE_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>{title}</title>
+    <script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+    <script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
+    <script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 20px; }}
+        .visualization {{ margin-bottom: 50px; }}
+    </style>
+</head>
+<body>
+    <h1>{title}</h1>
+{body}
+</body>
+</html>
+"""
+
+CHARTJS_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>{title}</title>
+    <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 20px; }}
+        .visualization {{ margin-bottom: 50px; }}
+    </style>
+</head>
+<body>
+    <h1>{title}</h1>
+{body}
+</body>
+</html>
+"""
+
+
+class Dataset:
+    """A parsed dataset and everything the prompts need, built once per batch."""
+
+    def __init__(self, source):
+        self.source = source
+        if source.startswith(("http://", "https://")):
+            df, _ = fetch_csv(source)
+            self.df = optimize_dataframe(df)
+            self.description, self.columns = infer_csv_structure(self.df)
+        else:
+            self.df = read_csv_cached(source, optimize=True)
+            self.description, self.columns = dataset_profile(source, self.df, optimize=True)
+        self.sample = dataframe_to_records(self.df.head(5))
+        self.field_types = detect_field_types(self.df)
+        self._records_json = None
+
+    @property
+    def records_json(self):
+        # Serialized lazily: only Vega-Lite pages embed the full data.
+        if self._records_json is None:
+            self._records_json = json.dumps(dataframe_to_records(self.df))
+        return self._records_json
+
+
+def vega_lite_messages(dataset, prompt):
+    instructions = [
+        "You are an assistant that generates Vega-Lite JSON specifications based on user requests and provided data."
+        " Do **not** include the 'data' field in your specification; the data is injected by the application."
+        " Respond **only** with the Vega-Lite JSON specification, with no explanations or additional text.",
+    ]
+    context = [
+        *memoized_context(dataset.description, dataset.columns, dataset.sample, dataset.field_types),
+        f"Use these Vega-Lite field types in every encoding:\n{describe_field_types(dataset.field_types)}",
+    ]
+    return build_messages(instructions, context, [{"role": "user", "content": prompt}])
+
+
+def chartjs_messages(dataset, prompt):
+    instructions = [
+        "You are an assistant that generates **valid** Chart.js configuration objects based on user requests and provided data. "
+        "Ensure that all JSON syntax rules are followed, including quoting all keys with double quotes and avoiding any comments or placeholders. "
+        "Populate all data fields with actual numerical values extracted from the provided dataset.",
+    ]
+    context = [
+        *memoized_context(dataset.description, dataset.columns),
+    ]
+    return build_messages(instructions, context, [{"role": "user", "content": prompt}])
+
+
+class OutputFile:
+    """Charts collected for one HTML file, written once when the batch ends."""
+
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        self.datasets = {}  # source -> JS variable holding its records
+        self.sections = []
+
+    def add(self, job_id, dataset, config):
+        element_id = f"chart_{len(self.sections)}"
+        title = html.escape(str(job_id))
+        if self.backend == "chartjs":
+            self.sections.append(
+                f"""    <div class="visualization">
+        <h2>{title}</h2>
+        <canvas id="{element_id}"></canvas>
+        <script>
+            new Chart(document.getElementById("{element_id}").getContext("2d"), {json.dumps(config)});
+        </script>
+    </div>"""
+            )
+            return
+        variable = self.datasets.get(dataset.source)
+        if variable is None:
+            # Each dataset is embedded once per page and shared by its charts.
+            variable = self.datasets[dataset.source] = f"dataset_{len(self.datasets)}"
+            self.sections.append(f"    <script>const {variable} = {dataset.records_json};</script>")
+        config = dict(config, data={"values": "__DATA__"})
+        spec_json = json.dumps(config).replace('"__DATA__"', variable)
+        self.sections.append(
+            f"""    <div class="visualization">
+        <h2>{title}</h2>
+        <div id="{element_id}"></div>
+        <script>vegaEmbed("#{element_id}", {spec_json}).catch(console.error);</script>
+    </div>"""
+        )
+
+    def write(self):
+        page = CHARTJS_PAGE if self.backend == "chartjs" else VEGA_LITE_PAGE
+        title = "Chart.js Visualizations" if self.backend == "chartjs" else "Vega-Lite Visualizations Dashboard"
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_output(self.path, page.format(title=title, body="\n".join(self.sections)))
+
+
+def parse_job(line, line_number):
+    """
+    The job on one line of the jobs file. A job that cannot run (invalid
+    JSON, an unknown backend, a missing key) gets an "error" that is
+    reported in its result while the rest of the batch still runs.
+    """
+    try:
+        job = json.loads(line)
+    except ValueError as e:
+        return {"id": str(line_number), "error": f"invalid JSON: {e}"}
+    if not isinstance(job, dict):
+        return {"id": str(line_number), "error": "job is not a JSON object"}
+    job.setdefault("id", str(line_number))
+    job.setdefault("backend", "vega-lite")
+    if job["backend"] not in BACKENDS:
+        job["error"] = f"unknown backend {job['backend']!r}"
+        return job
+    job.setdefault("output", f"output-batch-{job['backend']}.html")
+    missing = [key for key in REQUIRED_KEYS if key not in job]
+    if missing:
+        job["error"] = f"missing {', '.join(repr(key) for key in missing)}"
+    return job
+
+
+def read_jobs(jobs_path):
+    with open(jobs_path, "r") as f:
+        return [parse_job(line, line_number) for line_number, line in enumerate(f, start=1) if line.strip()]
+
+
+async def run_job(job, client, datasets, outputs, semaphore, timeout):
+    queued = time.perf_counter()
+    result = {"id": job["id"], "dataset": job.get("dataset"), "output": job.get("output")}
+    if "error" in job:
+        result.update(status="error", error=job["error"])
+        return result
+    async with semaphore:
+        start = time.perf_counter()
+        result["queued_seconds"] = round(start - queued, 4)
+        try:
+            task = datasets.get(job["dataset"])
+            if task is None:
+                task = datasets[job["dataset"]] = asyncio.ensure_future(
+                    asyncio.to_thread(Dataset, job["dataset"])
+                )
+            dataset = await task
+            loaded = time.perf_counter()
+            result["load_seconds"] = round(loaded - start, 4)
+
+            if job["backend"] == "chartjs":
+                messages_for, response_format = chartjs_messages, json_mode_request()
+            else:
+                schema = vega_lite_schema(dataset.columns)
+                messages_for, response_format = vega_lite_messages, structured_request("vega_lite_spec", schema)
+            reply = await asyncio.wait_for(
+                async_cached_chat_completion(
+                    client,
+                    model=job.get("model", "gpt-4o"),
+                    messages=messages_for(dataset, job["prompt"]),
+                    temperature=0.3,
+                    max_tokens=2000,
+                    stream=True,
+                    **response_format,
+                ),
+                timeout=timeout,
+            )
+            result["llm_seconds"] = round(time.perf_counter() - loaded, 4)
+            if response_format:
+                config = parse_structured(reply)
+            else:
+                spec_text = extract_json(reply)
+                if not spec_text:
+                    raise ValueError("reply contained no JSON object")
+                try:
+                    config = json.loads(spec_text)
+                except json.JSONDecodeError:
+                    JSON_PARSE_FAILURES.labels(reason="invalid_json").inc()
+                    raise
+            if job["backend"] == "vega-lite":
+                config.pop("data", None)
+                apply_field_types(config, dataset.field_types)
+            output = outputs.get(job["output"])
+            if output is None:
+                output = outputs[job["output"]] = OutputFile(job["output"], job["backend"])
+            output.add(job["id"], dataset, config)
+            result["status"] = "ok"
+            TIME_TO_CHART_SECONDS.labels(entry_point="batch").observe(time.perf_counter() - queued)
+        except asyncio.TimeoutError:
+            result.update(status="error", error=f"timed out after {timeout:g}s")
+        except Exception as e:
+            result.update(status="error", error=f"{type(e).__name__}: {e}")
+        result["total_seconds"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+async def run_batch(jobs, results_path, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, client=None):
+    """Run `jobs`, append one result per job to `results_path` and return the results."""
+    client = client or get_async_client()
+    semaphore = asyncio.Semaphore(concurrency)
+    datasets, outputs, results = {}, {}, []
+    pending = [
+        asyncio.ensure_future(run_job(job, client, datasets, outputs, semaphore, timeout))
+        for job in jobs
+    ]
+    with open(results_path, "a") as results_file:
+        for finished in asyncio.as_completed(pending):
+            result = await finished
+            results.append(result)
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+    for output in outputs.values():
+        output.write()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate charts in bulk from a JSONL file of jobs.")
+    parser.add_argument("jobs", help="JSONL file with one job per line")
+    parser.add_argument("--results", default="batch-results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds per LLM call")
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.jobs)
+    start = time.perf_counter()
+    results = asyncio.run(run_batch(jobs, args.results, args.concurrency, args.timeout))
+    failed = sum(result["status"] != "ok" for result in results)
+    print(
+        f"{len(results) - failed}/{len(results)} jobs succeeded in "
+        f"{time.perf_counter() - start:.1f}s; results appended to {args.results}"
+    )
+    print_cache_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,631 @@
+"""
+Micro-benchmarks for the ingestion and LLM pipeline.
+
+Usage:
+    python benchmark.py <name> [args...]
+
+Run without arguments to list the available benchmarks.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from utils import format_ingest_stats
+
+
+def scale_csv(src_path, factor, dest_path):
+    """Write `src_path` to `dest_path` with its data rows repeated `factor` times."""
+    with open(src_path, "r") as src:
+        header = src.readline()
+        body = src.read()
+    if not body.endswith("\n"):
+        body += "\n"
+    with open(dest_path, "w") as dest:
+        dest.write(header)
+        for _ in range(factor):
+            dest.write(body)
+    return dest_path
+
+
+def _read_in_child(queue, file_path, chunked):
+    # Each reader runs in its own process so peak RSS is not shared between runs.
+    import pandas as pd
+    from utils import read_csv_chunked, _ingest_stats
+
+    if chunked:
+        _, stats = read_csv_chunked(file_path)
+    else:
+        start = time.perf_counter()
+        df = pd.read_csv(file_path)
+        stats = _ingest_stats(df, start)
+    queue.put(stats)
+
+
+def _run_isolated(target, *args):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(queue, *args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def bench_read_csv(src_path="real_estate.csv", factor="1000"):
+    """Compare plain pd.read_csv with the chunked, dtype-aware reader."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        size_mib = os.path.getsize(scaled) / 2**20
+        print(f"{src_path} x{factor}: {size_mib:.1f} MiB on disk")
+        for label, chunked in (("pd.read_csv", False), ("read_csv_chunked", True)):
+            stats = _run_isolated(_read_in_child, scaled, chunked)
+            print(f"{label:>18}: {format_ingest_stats(stats)}")
+
+
+def bench_dataset_cache(src_path="real_estate.csv", factor="1000"):
+    """Time a cold parse against a warm dataset-cache load."""
+    from dataset_cache import DatasetCache, read_csv_cached
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        cache = DatasetCache(cache_dir=os.path.join(tmp_dir, "cache"))
+        for label in ("cold (parse + store)", "warm (cache hit)"):
+            start = time.perf_counter()
+            df = read_csv_cached(scaled, cache=cache)
+            elapsed = time.perf_counter() - start
+            print(f"{label:>20}: {len(df)} rows in {elapsed * 1000:.1f} ms")
+
+
+def _serve_csv(body, etag):
+    """Start a local HTTP server that serves `body` gzipped and honours If-None-Match."""
+    import gzip
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    compressed = gzip.compress(body)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(compressed)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(compressed)
+            self.server.bytes_sent += len(compressed)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.bytes_sent = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_http_fetch(src_path="real_estate.csv", factor="1000", repeats="3"):
+    """Bytes transferred and time-to-DataFrame for first and repeat URL loads."""
+    import pandas as pd
+    from http_fetch import fetch_csv
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        with open(scaled, "rb") as f:
+            body = f.read()
+        server = _serve_csv(body, etag='"bench-v1"')
+        url = f"http://127.0.0.1:{server.server_address[1]}/scaled.csv"
+        os.environ["VIZ_CACHE_DIR"] = os.path.join(tmp_dir, "cache")
+        try:
+            start = time.perf_counter()
+            plain_df = pd.read_csv(url)
+            print(
+                f"{'pd.read_csv(url)':>16}: {server.bytes_sent} bytes transferred, "
+                f"{len(plain_df)} rows in {(time.perf_counter() - start) * 1000:.1f} ms"
+            )
+            for attempt in range(1 + int(repeats)):
+                _, stats = fetch_csv(url)
+                label = "first fetch" if attempt == 0 else f"repeat {attempt}"
+                print(
+                    f"{label:>16}: HTTP {stats['status']}, {stats['bytes_transferred']} bytes "
+                    f"transferred, {stats['rows']} rows in {stats['seconds'] * 1000:.1f} ms"
+                )
+        finally:
+            server.shutdown()
+
+
+def bench_read_many(src_path="real_estate.csv", files="16", factor="200"):
+    """Serial versus process-pool parsing of a directory of partitioned CSVs."""
+    from utils import expand_csv_paths, read_csv_many
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(int(files)):
+            scale_csv(src_path, int(factor), os.path.join(tmp_dir, f"part-{i:03d}.csv"))
+        paths = expand_csv_paths(tmp_dir)
+        timings = {}
+        for workers in sorted({1, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            df = read_csv_many(paths, max_workers=workers)
+            timings[workers] = time.perf_counter() - start
+            print(
+                f"{workers:>3} worker(s): {len(paths)} files, {len(df)} rows "
+                f"in {timings[workers]:.2f}s ({timings[1] / timings[workers]:.2f}x)"
+            )
+
+
+def bench_optimize(src_path="sample.csv", factor="10000"):
+    """Per-column memory before and after optimize_dataframe."""
+    import pandas as pd
+    from utils import optimize_dataframe
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        df = pd.read_csv(scaled)
+        start = time.perf_counter()
+        optimize_dataframe(df, report=True)
+        print(f"Optimized {len(df)} rows in {time.perf_counter() - start:.2f}s")
+
+
+def bench_sniff(src_path="real_estate.csv", factor="1000"):
+    """Time-to-summary from a sniffed sample versus a full parse and describe()."""
+    import pandas as pd
+    from utils import sniff_csv, summarize_sample
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        start = time.perf_counter()
+        df = pd.read_csv(scaled)
+        df.describe(include="all").to_dict()
+        print(f"{'full parse':>12}: {len(df)} rows in {(time.perf_counter() - start) * 1000:.1f} ms")
+        start = time.perf_counter()
+        sample, estimated_rows = sniff_csv(scaled)
+        summarize_sample(sample, estimated_rows)
+        print(
+            f"{'sniff':>12}: {len(sample)} rows sampled, ~{estimated_rows} estimated "
+            f"in {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+
+
+def bench_profile(src_path="real_estate.csv", factor="1000"):
+    """describe(include="all") versus the sketch profiler, in memory and streamed."""
+    import pandas as pd
+    from profiler import profile_csv, profile_dataframe
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        df = pd.read_csv(scaled)
+        runs = (
+            ("describe()", lambda: df.describe(include="all").to_dict()),
+            ("profile_dataframe", lambda: profile_dataframe(df).describe()),
+            ("profile_csv", lambda: profile_csv(scaled).describe()),
+        )
+        for label, run in runs:
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+            print(f"{label:>18}: best of 3 {min(timings) * 1000:.1f} ms")
+
+
+def bench_field_types(src_path="real_estate.csv", factor="1000"):
+    """Vectorized semantic field-type detection on a scaled frame."""
+    import pandas as pd
+    from semantic_types import describe_field_types, detect_field_types
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scaled = scale_csv(src_path, int(factor), os.path.join(tmp_dir, "scaled.csv"))
+        df = pd.read_csv(scaled)
+        start = time.perf_counter()
+        field_types = detect_field_types(df)
+        elapsed = time.perf_counter() - start
+        print(describe_field_types(field_types))
+        print(f"Typed {len(df.columns)} columns over {len(df)} rows in {elapsed * 1000:.1f} ms")
+
+
+def bench_summary(src_path="real_estate.csv", copies="20", budget="400", context_budget="800"):
+    """Prompt tokens of the indented describe() JSON versus the compact summary and full dataset context."""
+    import json
+
+    import pandas as pd
+    from prompt_summary import compact_summary, count_tokens, dataset_context
+    from utils import dataframe_to_records, infer_csv_structure
+
+    df = pd.read_csv(src_path)
+    # Widen the table by repeating its columns under new names.
+    wide = pd.concat([df.add_suffix(f" {i}") for i in range(int(copies))], axis=1)
+    for label, frame in ((src_path, df), (f"{copies}x wider", wide)):
+        description, columns = infer_csv_structure(frame)
+        start = time.perf_counter()
+        _, tokens = compact_summary(description, budget=int(budget))
+        elapsed = time.perf_counter() - start
+        sample = dataframe_to_records(frame.head(5))
+        _, context_tokens = dataset_context(description, columns, sample, budget=int(context_budget))
+        print(
+            f"{label:>18}: {len(frame.columns)} columns, describe JSON "
+            f"{count_tokens(json.dumps(description, indent=2, default=str))} tokens, compact {tokens} tokens "
+            f"(budget {budget}) in {elapsed * 1000:.1f} ms; summary, columns and sample "
+            f"{context_tokens} tokens (budget {context_budget})"
+        )
+
+
+def bench_llm_cache(requests="1000"):
+    """Miss and hit latency of the SQLite response cache (no network)."""
+    from types import SimpleNamespace
+    from llm_cache import ResponseCache, cached_chat_completion, format_cache_stats
+
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='{"mark": "bar"}'))])
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **request: reply))
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = ResponseCache(path=os.path.join(tmp_dir, "responses.sqlite"))
+        prompts = [
+            [{"role": "user", "content": f"Plot column {i} against time"}] for i in range(int(requests))
+        ]
+        for label in ("miss (store)", "hit (memory)"):
+            start = time.perf_counter()
+            for messages in prompts:
+                cached_chat_completion(
+                    client, cache=cache, model="gpt-4o", messages=messages, temperature=0.3, max_tokens=2000
+                )
+            per_call = (time.perf_counter() - start) / len(prompts)
+            print(f"{label:>14}: {per_call * 1e6:.1f} us per request")
+        # A fresh instance has an empty memory layer, so every lookup reads SQLite.
+        cache = ResponseCache(path=cache.path)
+        start = time.perf_counter()
+        for messages in prompts:
+            cached_chat_completion(
+                client, cache=cache, model="gpt-4o", messages=messages, temperature=0.3, max_tokens=2000
+            )
+        per_call = (time.perf_counter() - start) / len(prompts)
+        print(f"{'hit (sqlite)':>14}: {per_call * 1e6:.1f} us per request")
+        print(format_cache_stats(cache.stats()))
+
+
+def bench_stream(chunk_ms="20", prose_chunks="60"):
+    """Time-to-spec for a blocking reply versus a stream cut off at the closing brace."""
+    import json
+    from types import SimpleNamespace
+    from llm_cache import cached_chat_completion
+
+    spec = json.dumps({"mark": "bar", "encoding": {"x": {"field": "Site"}, "y": {"field": "Visits"}}})
+    pieces = [spec[i : i + 4] for i in range(0, len(spec), 4)]
+    pieces += [" This chart compares visits."] * int(prose_chunks)
+    delay = float(chunk_ms) / 1000
+
+    class FakeStream:
+        def __init__(self):
+            self.sent = 0
+
+        def __iter__(self):
+            for piece in pieces:
+                time.sleep(delay)  # simulated per-chunk generation time
+                self.sent += 1
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+        def close(self):
+            pass
+
+    def create(stream=False, **request):
+        response = FakeStream()
+        if stream:
+            return response
+        text = "".join(chunk.choices[0].delta.content for chunk in response)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    os.environ["VIZ_LLM_CACHE"] = "0"
+    for label, stream in (("blocking", False), ("streamed", True)):
+        start = time.perf_counter()
+        reply = cached_chat_completion(
+            client, model="gpt-4o", messages=[], temperature=0.3, max_tokens=2000, stream=stream
+        )
+        print(
+            f"{label:>9}: spec after {(time.perf_counter() - start) * 1000:.0f} ms, "
+            f"{len(reply)} reply chars kept of {sum(map(len, pieces))}"
+        )
+
+
+def bench_spec_cache(entries="5000", lookups="2000"):
+    """Lookup latency and hit rate of the near-duplicate spec cache over paraphrased prompts."""
+    import random
+    from spec_cache import SpecCache
+
+    columns = [f"Metric {i}" for i in range(40)] + ["Region", "Month"]
+    marks = ["bar chart", "line chart", "pie chart", "scatter plot", "area chart"]
+    extras = ["", "sorted descending", "in red", "with tooltips", "stacked", "log scale"]
+    rng = random.Random(0)
+
+    def prompt(i, paraphrase=False):
+        metric, mark, extra = columns[i % 40], marks[i // 40 % 5], extras[i // 200 % 6]
+        if paraphrase:
+            return f"please show me the {metric} per region as a {mark} {extra}"
+        return f"{mark} of {metric} by region {extra}"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = SpecCache(path=os.path.join(tmp_dir, "specs.sqlite"))
+        start = time.perf_counter()
+        for i in range(int(entries)):
+            cache.put("vega-lite", columns, prompt(i), f'{{"spec": {i}}}', context=[{"turn": i // 1200}])
+        print(f"stored {entries} specs in {(time.perf_counter() - start) * 1000:.0f} ms")
+        start = time.perf_counter()
+        for _ in range(int(lookups)):
+            i = rng.randrange(int(entries))
+            cache.get("vega-lite", columns, prompt(i, paraphrase=True), context=[{"turn": i // 1200}])
+        elapsed = time.perf_counter() - start
+        stats = cache.stats()
+        print(
+            f"{lookups} paraphrased lookups: {elapsed / int(lookups) * 1e6:.0f} µs each, "
+            f"{stats['exact_hits']} exact + {stats['similar_hits']} near-duplicate hits, {stats['misses']} misses"
+        )
+
+
+def bench_local_spec(src_path="sample.csv", repeats="1000"):
+    """Time-to-spec of the rule-based parser, and which prompts it leaves to the LLM."""
+    import pandas as pd
+    from intent_parser import local_spec
+    from semantic_types import detect_field_types
+
+    field_types = detect_field_types(pd.read_csv(src_path))
+    columns = list(field_types)
+    prompts = [
+        f"line chart of {columns[-1]} by {columns[0]} colored by {columns[1]}",
+        f"bar chart of {columns[-1]} by {columns[1]}",
+        f"average {columns[-1]} per {columns[0]} as bars",
+        f"pie chart of {columns[-1]} by {columns[1]}",
+        f"bar chart of {columns[-1]} by {columns[1]}, top 5 only",
+    ]
+    for prompt in prompts:
+        start = time.perf_counter()
+        for _ in range(int(repeats)):
+            spec = local_spec(prompt, field_types)
+        elapsed = (time.perf_counter() - start) / int(repeats)
+        outcome = "local" if spec else "LLM fallback"
+        print(f"{elapsed * 1e6:8.0f} µs  {outcome:<12}  {prompt}")
+
+
+def bench_prompt_layout(src_path="real_estate.csv", turns="20", budget="3000"):
+    """Provider-cached share of prompt tokens over a session, old layout versus prompt_layout's."""
+    import json
+
+    import pandas as pd
+    from conversation import ConversationHistory
+    from llm_server import PrefixCache
+
+    df = pd.read_csv(src_path)
+    system_prompt = (
+        "You are an expert in data visualization. Given a dataset and a user's goal, recommend the most"
+        " appropriate chart type (bar, line or pie), its x and y columns, any transformations, and a rationale."
+        " Output a JSON object with chart_type, x_column, y_column, transformations and rationale.\n"
+    ) * 4
+    details = (
+        f"Dataset Details:\nColumns: {list(df.columns)}\nData Preview:\n{df.head().to_string()}\n"
+        f"Column Types:\n{df.dtypes.to_string()}"
+    )
+
+    def old_layout(history, goal):
+        # Before: the dataset rode along in every user message and the summary of
+        # dropped turns sat right after the system prompt.
+        messages = history.build(system_prompt, f"{details}\n\nUser Context/Goal: {goal}")
+        summaries = [m for m in messages[1:] if m["role"] == "system"]
+        rest = [m for m in messages[1:] if m["role"] != "system"]
+        return messages[:1] + summaries + rest
+
+    def new_layout(history, goal):
+        return history.build(system_prompt, f"User Context/Goal: {goal}", details)
+
+    for label, layout in (("old layout", old_layout), ("prompt_layout", new_layout)):
+        history, cache = ConversationHistory(int(budget)), PrefixCache()
+        prompt_tokens = cached_tokens = 0
+        for i in range(int(turns)):
+            column = df.columns[i % len(df.columns)]
+            goal = f"Show how {column} varies, version {i}"
+            tokens, cached = cache.lookup(layout(history, goal))
+            prompt_tokens += tokens
+            cached_tokens += cached
+            reply = {"chart_type": "bar", "x_column": str(column), "y_column": str(df.columns[-1]), "rationale": goal}
+            history.record(goal, json.dumps(reply))
+        print(
+            f"{label:>14}: {prompt_tokens} prompt tokens over {turns} turns, "
+            f"{cached_tokens} cached ({cached_tokens / prompt_tokens:.0%})"
+        )
+
+
+def bench_extract_json(size="5000", repeats="3"):
+    """The old recursive-regex extract_json versus the single-pass scanner on adversarial replies."""
+    import json
+
+    import regex
+    from utils import extract_json
+
+    def recursive_regex(text):
+        # The previous implementation, compiled on every call as it was, with
+        # an array alternative so array replies can be compared too.
+        match = regex.compile(r"\{(?:[^{}\[\]]|(?0))*\}|\[(?:[^{}\[\]]|(?0))*\]").search(text)
+        return match.group() if match else None
+
+    n = int(size)
+    spec = json.dumps({
+        "mark": "bar",
+        "encoding": {"x": {"field": "Site", "type": "nominal"}, "y": {"field": "Visits", "type": "quantitative"}},
+    })
+    rows = [{"label": f"row {i} {{x}}", "value": i} for i in range(n // 20)]
+    inputs = {
+        "short reply": f"Here is the chart:\n{spec}\nLet me know if you want changes.",
+        "long prose, then spec": "The data shows a steady trend. " * (n // 30) + spec,
+        "long prose, no JSON": "The data shows a steady trend. " * (n // 30),
+        "braces in strings": json.dumps({"title": "{" * (n // 2) + "}" * (n // 4), "spec": json.loads(spec)}),
+        "unbalanced braces": "{ " * (n // 20) + spec,
+        "truncated reply": json.dumps({"data": {"values": rows}, **json.loads(spec)})[: n // 2],
+        "array of specs": "Here are the charts:\n" + json.dumps([json.loads(spec)] * max(n // 200, 1)),
+        "truncated array": json.dumps(rows)[: n // 2],
+    }
+    for label, text in inputs.items():
+        timings = {}
+        for name, func in (("recursive regex", recursive_regex), ("scanner", extract_json)):
+            start = time.perf_counter()
+            for _ in range(int(repeats)):
+                result = func(text)
+            timings[name] = ((time.perf_counter() - start) / int(repeats), result)
+        (old_time, old_result), (new_time, new_result) = timings["recursive regex"], timings["scanner"]
+        same = "same result" if old_result == new_result else "different result"
+        print(
+            f"{label:>22} ({len(text):>6} chars): regex {old_time * 1000:9.3f} ms, "
+            f"scanner {new_time * 1000:7.3f} ms ({old_time / max(new_time, 1e-9):7.1f}x), {same}"
+        )
+
+
+def _serve_mock_llm(queue, latency, recordings_path, chunk_delay=0.0, invalid_rate=0.0):
+    # The server gets its own process so it doesn't compete with the client for the GIL.
+    from llm_server import LLMServer
+
+    server = LLMServer(
+        ("127.0.0.1", 0),
+        recordings_path=recordings_path,
+        latency=latency,
+        chunk_delay=chunk_delay,
+        invalid_rate=invalid_rate,
+    )
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def bench_mock_llm(requests="200", concurrency="16", latency_ms="50"):
+    """Sequential versus concurrent request throughput against the local mock server."""
+    import asyncio
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(
+            target=_serve_mock_llm,
+            args=(queue, float(latency_ms) / 1000, os.path.join(tmp_dir, "recordings.jsonl")),
+            daemon=True,
+        )
+        server.start()
+        os.environ["VIZ_LLM_BASE_URL"] = f"http://127.0.0.1:{queue.get()}/v1"
+        os.environ["VIZ_LLM_CACHE"] = "0"
+        from llm_cache import async_cached_chat_completion
+        from openai_client import get_async_client
+
+        total = int(requests)
+
+        def request(i):
+            messages = [
+                {"role": "system", "content": "Columns: Site, Visits"},
+                {"role": "user", "content": f"Chart number {i}"},
+            ]
+            return dict(model="gpt-4o", messages=messages, temperature=0.3, max_tokens=2000, stream=True)
+
+        async def run(limit):
+            client = get_async_client()
+            semaphore = asyncio.Semaphore(limit)
+
+            async def one(i):
+                async with semaphore:
+                    return await async_cached_chat_completion(client, **request(i))
+
+            start = time.perf_counter()
+            replies = await asyncio.gather(*(one(i) for i in range(total)))
+            elapsed = time.perf_counter() - start
+            assert all(replies)
+            print(f"concurrency {limit:>3}: {total} requests in {elapsed:.2f}s ({total / elapsed:.0f} req/s)")
+
+        for limit in (1, int(concurrency)):
+            asyncio.run(run(limit))
+        server.terminate()
+
+
+def bench_speculative(requests="100", candidates="3", invalid_rate="0.2", latency_ms="50", chunk_ms="2"):
+    """Time to a valid spec with retries on invalid JSON, single versus speculative candidates."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(
+            target=_serve_mock_llm,
+            args=(
+                queue,
+                float(latency_ms) / 1000,
+                os.path.join(tmp_dir, "recordings.jsonl"),
+                float(chunk_ms) / 1000,
+                float(invalid_rate),
+            ),
+            daemon=True,
+        )
+        server.start()
+        os.environ["VIZ_LLM_BASE_URL"] = f"http://127.0.0.1:{queue.get()}/v1"
+        os.environ["VIZ_LLM_CACHE"] = "0"
+        from metrics import LLM_TOKENS
+        from openai_client import get_client
+        from speculative import is_vega_lite_spec, speculative_chat_completion, speculative_stats
+
+        def completion_tokens():
+            return LLM_TOKENS.labels(model="gpt-4o", kind="completion")._value.get()
+
+        for count in (1, int(candidates)):
+            os.environ["VIZ_LLM_CANDIDATES"] = str(count)
+            tokens_before, round_trips, timings = completion_tokens(), 0, []
+            for i in range(int(requests)):
+                messages = [
+                    {"role": "system", "content": "Columns: Site, Visits"},
+                    {"role": "user", "content": f"Chart number {i} with {count} candidates"},
+                ]
+                start = time.perf_counter()
+                while True:  # an invalid reply means asking again, as the user would
+                    round_trips += 1
+                    reply = speculative_chat_completion(
+                        get_client(), validate=is_vega_lite_spec,
+                        model="gpt-4o", messages=messages, temperature=0.3, max_tokens=2000, stream=True,
+                    )
+                    if reply and is_vega_lite_spec(reply[reply.find("{"):]):
+                        break
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(
+                f"{count} candidate(s): mean {sum(timings) / len(timings) * 1000:.0f} ms, "
+                f"p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.0f} ms to a valid spec, "
+                f"{round_trips} round-trips for {requests} specs, "
+                f"{completion_tokens() - tokens_before:.0f} completion tokens"
+            )
+        print(speculative_stats())
+        server.terminate()
+
+
+BENCHMARKS = {
+    "read_csv": bench_read_csv,
+    "dataset_cache": bench_dataset_cache,
+    "http_fetch": bench_http_fetch,
+    "read_many": bench_read_many,
+    "optimize": bench_optimize,
+    "sniff": bench_sniff,
+    "profile": bench_profile,
+    "field_types": bench_field_types,
+    "summary": bench_summary,
+    "llm_cache": bench_llm_cache,
+    "stream": bench_stream,
+    "spec_cache": bench_spec_cache,
+    "local_spec": bench_local_spec,
+    "mock_llm": bench_mock_llm,
+    "prompt_layout": bench_prompt_layout,
+    "speculative": bench_speculative,
+    "extract_json": bench_extract_json,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__.strip())
+        print("\nBenchmarks:")
+        for name, func in BENCHMARKS.items():
+            print(f"  {name:<16} {func.__doc__.strip().splitlines()[0]}")
+        return
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
@@ -2,58 +2,51 @@ import pandas as pd
 import openai
 import json
 import os
-import regex as re
 import time
-from utils import get_openai_api_key
+from utils import (
+    get_openai_api_key,
+    dataframe_to_records,
+    should_sniff,
+    sniff_csv,
+    summarize_sample,
+)
+from dataset_cache import cached_profile, dataset_profile, read_csv_in_background
+from prompt_summary import memoized_context
+from prompt_layout import build_messages
+from llm_cache import print_cache_stats
+from speculative import print_speculative_stats, speculative_chat_completion
+from structured_output import json_mode_request, reply_json
+from openai_client import get_client
+from metrics import TIME_TO_CHART_SECONDS, timed, write_output
+from spec_cache import lookup_spec, print_spec_cache_stats, store_spec
 
 openai.api_key = get_openai_api_key()
 
-def read_csv(file_path):
-    try:
-        df = pd.read_csv(file_path)
-        return df
-    except Exception as e:
-        raise ValueError(f"Error reading CSV file: {e}")
-
-def infer_csv_structure(df):
-    description = df.describe(include="all").to_dict()
-    columns = df.columns.tolist()
-    return description, columns
-
-def extract_json(text):
-    json_pattern = re.compile(r"\{(?:[^{}]|(?0))*\}")
-    match = json_pattern.search(text)
-    if match:
-        return match.group()
-    return None
-
+@timed("send_message_to_openai")
 def send_message_to_openai(conversation, dataframe_info, column_info, api_key):
-    system_prompts = [
-        {
-            "role": "system",
-            "content": (
-                "You are an assistant that generates **valid** Chart.js configuration objects based on user requests and provided data. "
-                "Ensure that all JSON syntax rules are followed, including quoting all keys with double quotes and avoiding any comments or placeholders. "
-                "Populate all data fields with actual numerical values extracted from the provided dataset."
-            ),
-        },
-        {
-            "role": "system",
-            "content": f"Here is a summary of the CSV data:\n{json.dumps(dataframe_info, indent=2)}",
-        },
-        {"role": "system", "content": f"Columns: {', '.join(column_info)}"},
+    instructions = [
+        (
+            "You are an assistant that generates **valid** Chart.js configuration objects based on user requests and provided data. "
+            "Ensure that all JSON syntax rules are followed, including quoting all keys with double quotes and avoiding any comments or placeholders. "
+            "Populate all data fields with actual numerical values extracted from the provided dataset."
+        ),
     ]
-    
-    messages = system_prompts + conversation
+    context = [
+        *memoized_context(dataframe_info, column_info),
+    ]
+    # Static instructions first, then this dataset, then the turns: see prompt_layout.
+    messages = build_messages(instructions, context, conversation)
 
     try:
-        response = openai.chat.completions.create(
+        assistant_reply = speculative_chat_completion(
+            get_client(),
             model="gpt-4o",
             messages=messages,
             temperature=0.3,
             max_tokens=2000,
+            stream=True,
+            **json_mode_request(),
         )
-        assistant_reply = response.choices[0].message.content
         return assistant_reply
     except Exception as e:
         raise ConnectionError(f"Error communicating with OpenAI: {e}")
@@ -84,6 +77,7 @@ def initialize_html(html_file='output-chartjs.html'):
 </html>
 """)
 
+@timed("append_json_to_html")
 def append_json_to_html(config_data, data, html_file='output-chartjs.html'):
     initialize_html(html_file)
     chart_id = f"chart_{int(time.time() * 1000)}"
@@ -117,8 +111,7 @@ def append_json_to_html(config_data, data, html_file='output-chartjs.html'):
         insertion_point = len(content)
 
     new_content = content[:insertion_point] + visualization_html + content[insertion_point:]
-    with open(html_file, 'w') as f:
-        f.write(new_content)
+    write_output(html_file, new_content)
 
 def main():
     try:
@@ -126,14 +119,29 @@ def main():
     except ValueError as ve:
         print(ve)
         return
-    csv_path = input("Enter the path to your CSV file: ").strip()
+    csv_path = input("Enter the path to your CSV file (or a directory or glob of CSV files): ").strip()
     try:
-        df = read_csv(csv_path)
-        print("\nCSV file successfully uploaded and read!")
+        df_future = read_csv_in_background(csv_path, optimize=True)
+        if should_sniff(csv_path):
+            # Large file: prompt from a sample while the full load finishes in the background.
+            sample, estimated_rows = sniff_csv(csv_path)
+            columns = sample.columns.tolist()
+            profile = cached_profile(csv_path, optimize=True)
+            if profile:
+                description = profile[0]
+            else:
+                description = summarize_sample(sample, estimated_rows)
+            print(
+                f"\nSampled {len(sample)} of ~{estimated_rows} rows; "
+                "loading the rest in the background."
+            )
+        else:
+            sample = df_future.result()
+            description, columns = dataset_profile(csv_path, sample, optimize=True)
+            print("\nCSV file successfully uploaded and read!")
     except ValueError as ve:
         print(ve)
         return
-    description, columns = infer_csv_structure(df)
     print("\n--- DataFrame Summary ---")
     print(pd.DataFrame(description).transpose())
     conversation = []
@@ -142,23 +150,28 @@ def main():
         "\nStart chatting with the assistant. Type 'exit' or 'quit' to end the session.\n"
     )
     initialize_html()
-    data_as_json = df.to_dict(orient='records')
+    data_as_json = None  # built once the full load has finished
 
     while True:
         user_input = input("You: ").strip()
+        turn_start = time.perf_counter()
         if user_input.lower() in ["exit", "quit"]:
             print("Ending the chat. Goodbye!")
+            print_cache_stats()
+            print_spec_cache_stats()
+            print_speculative_stats()
             break
         if user_input:
             conversation.append({"role": "user", "content": user_input})
+        cached_spec = lookup_spec("chartjs", columns, user_input, conversation[:-1])
         try:
-            assistant_reply = send_message_to_openai(
+            assistant_reply = cached_spec or send_message_to_openai(
                 conversation, description, columns, api_key
             )
         except ConnectionError as ce:
             print(ce)
             continue
-        extracted_json = extract_json(assistant_reply)
+        extracted_json = reply_json(assistant_reply)
         if extracted_json:
             try:
                 chartjs_config = json.loads(extracted_json)
@@ -166,7 +179,11 @@ def main():
                 print(json.dumps(chartjs_config, indent=2))
                 
                 # Append the JSON to the HTML file with embedded data
+                if data_as_json is None:
+                    data_as_json = dataframe_to_records(df_future.result())
                 append_json_to_html(chartjs_config, data_as_json)
+                TIME_TO_CHART_SECONDS.labels(entry_point="chatjs-llm").observe(time.perf_counter() - turn_start)
+                store_spec("chartjs", columns, user_input, extracted_json, conversation[:-1])
 
                 conversation.append(
                     {"role": "assistant", "content": json.dumps(chartjs_config)}
@@ -0,0 +1,92 @@
+# conversation.py
+"""
+Bounded conversation history for multi-turn chart sessions.
+
+Each request is built as (see prompt_layout): its own system prompt (sent
+once, never accumulated), the dataset context if the request has one, the
+most recent turns that fit in the token budget, a one-line-per-turn summary
+of turns that no longer fit, and the new user message. The summary changes
+whenever the window slides, so it goes after the turns rather than in front
+of them. Histories are kept per dataset so switching files starts a clean
+context.
+"""
+import os
+
+from prompt_layout import build_messages
+from prompt_summary import count_tokens
+
+DEFAULT_HISTORY_TOKENS = int(os.getenv("VIZ_HISTORY_TOKENS", 3000))
+SUMMARY_TURNS = 10
+SUMMARY_CHARS = 80
+
+
+class ConversationHistory:
+    """Sliding window of (user, assistant) turns under a token budget."""
+
+    def __init__(self, budget=DEFAULT_HISTORY_TOKENS):
+        self.budget = budget
+        self.turns = []  # (user message, assistant message, tokens)
+
+    def record(self, user_content, assistant_content):
+        """Add a completed turn. `user_content` should be the short form worth replaying."""
+        turn = (
+            {"role": "user", "content": user_content},
+            {"role": "assistant", "content": assistant_content},
+        )
+        tokens = count_tokens(user_content) + count_tokens(assistant_content) + 8
+        self.turns.append(turn + (tokens,))
+
+    def _summary(self, older):
+        lines = []
+        for user, _, _ in older[-SUMMARY_TURNS:]:
+            request = " ".join(user["content"].split())
+            if len(request) > SUMMARY_CHARS:
+                request = request[: SUMMARY_CHARS - 1] + "…"
+            lines.append(f"- {request}")
+        skipped = len(older) - len(lines)
+        header = "Earlier in this session the user asked for"
+        if skipped:
+            header += f" (plus {skipped} older requests)"
+        return {"role": "system", "content": header + ":\n" + "\n".join(lines)}
+
+    def build(self, system_prompt, user_content, context=None):
+        """Messages for a new request: system prompt, context, history that fits, then the user message."""
+        user = {"role": "user", "content": user_content}
+        remaining = self.budget - count_tokens(system_prompt) - count_tokens(user_content)
+        if context:
+            remaining -= count_tokens(context)
+        kept = 0
+        for *_, tokens in reversed(self.turns):
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            kept += 1
+        summary = None
+        while kept < len(self.turns):
+            # The summary of dropped turns has to fit as well; give up recent turns until it does.
+            summary = self._summary(self.turns[: len(self.turns) - kept])
+            if count_tokens(summary["content"]) <= remaining or not kept:
+                break
+            remaining += self.turns[len(self.turns) - kept][2]
+            kept -= 1
+        turns = []
+        for user_message, assistant_message, _ in self.turns[len(self.turns) - kept :]:
+            turns += [user_message, assistant_message]
+        if summary:
+            turns.append(summary)
+        turns.append(user)
+        return build_messages([system_prompt], [context] if context else (), turns)
+
+    def clear(self):
+        self.turns = []
+
+
+_histories = {}
+
+
+def get_history(dataset_key, budget=DEFAULT_HISTORY_TOKENS):
+    """The history for one dataset (a path or URL), created on first use."""
+    history = _histories.get(dataset_key)
+    if history is None:
+        history = _histories[dataset_key] = ConversationHistory(budget)
+    return history
@@ -1,21 +1,7 @@
-import openai
 import altair as alt
 import pandas as pd
-import os
-import ast
 import webbrowser
-
-def get_openai_api_key():
-    """
-    Retrieve OpenAI API key from environment or user input.
-    
-    Returns:
-        str: OpenAI API key
-    """
-    api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        api_key = input("Please enter your OpenAI API key: ")
-    return api_key
+from openai_client import create_with_retries, get_client
 
 def generate_chart_code(prompt):
     """
@@ -27,8 +13,8 @@ def generate_chart_code(prompt):
     Returns:
         str: Generated Python code for creating an Altair chart
     """
-    # Initialize OpenAI client
-    client = openai.OpenAI(api_key=get_openai_api_key())
+    # Shared client: the API key is resolved and the connection pool built once per process
+    client = get_client()
     
     # Prepare the full prompt with context
     full_prompt = f"""
@@ -55,7 +41,8 @@ def generate_chart_code(prompt):
     """
     
     # Generate chart code
-    response = client.chat.completions.create(
+    response = create_with_retries(
+        client,
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are an expert in creating data visualizations and Altair charts."},
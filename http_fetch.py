@@ -0,0 +1,124 @@
+# http_fetch.py
+"""
+Conditional, streaming CSV fetches with a local HTTP cache.
+
+The first download is streamed through gzip decompression straight into the
+chunked CSV parser while the raw body is written to the cache. Later fetches
+send If-None-Match / If-Modified-Since; a 304 reuses the cached body (and the
+parsed frame in the dataset cache) without transferring it again.
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+from dataset_cache import cache_parsed_csv, get_cache_dir, read_csv_cached
+from utils import DEFAULT_CHUNKSIZE, read_csv_chunked
+
+REQUEST_TIMEOUT = 30
+
+
+class _CountingTee:
+    """File-like wrapper that counts bytes read and copies them to `sink`."""
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.bytes_read += len(data)
+        self.sink.write(data)
+        return data
+
+    def readable(self):
+        return True
+
+
+def _entry_paths(cache_dir, url):
+    key = hashlib.sha256(url.encode()).hexdigest()[:32]
+    return os.path.join(cache_dir, f"{key}.json"), os.path.join(cache_dir, key)
+
+
+def _load_entry(meta_path):
+    try:
+        with open(meta_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fetch_csv(url, cache_dir=None, chunksize=DEFAULT_CHUNKSIZE, report=False):
+    """
+    Fetch a CSV over HTTP(S), reusing the cached copy when the server answers
+    304 Not Modified.
+
+    Returns the DataFrame and a stats dict with the HTTP status, bytes
+    transferred and time-to-DataFrame.
+    """
+    cache_dir = cache_dir or get_cache_dir("http")
+    meta_path, body_base = _entry_paths(cache_dir, url)
+    entry = _load_entry(meta_path)
+    if entry and not os.path.exists(entry["body_path"]):
+        entry = None
+
+    headers = {"Accept-Encoding": "gzip"}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    start = time.perf_counter()
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or not entry:
+            raise
+        e.close()
+        df = read_csv_cached(entry["body_path"], chunksize=chunksize)
+        stats = {"status": 304, "bytes_transferred": 0}
+    else:
+        with response:
+            gzipped = (
+                response.headers.get("Content-Encoding", "").lower() == "gzip"
+                or url.split("?", 1)[0].endswith(".gz")
+            )
+            body_path = body_base + (".csv.gz" if gzipped else ".csv")
+            tmp_path = f"{body_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as sink:
+                    tee = _CountingTee(response, sink)
+                    stream = gzip.GzipFile(fileobj=tee) if gzipped else tee
+                    df, _ = read_csv_chunked(stream, chunksize=chunksize)
+                    # Drain anything the parser did not consume so the cached body is complete.
+                    while tee.read(2**16):
+                        pass
+                os.replace(tmp_path, body_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            entry = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "body_path": body_path,
+            }
+            with open(meta_path, "w") as f:
+                json.dump(entry, f)
+            cache_parsed_csv(body_path, df, chunksize=chunksize)
+            stats = {"status": response.status, "bytes_transferred": tee.bytes_read}
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["rows"] = len(df)
+    if report:
+        print(
+            f"HTTP {stats['status']}: {stats['bytes_transferred']} bytes transferred, "
+            f"{stats['rows']} rows in {stats['seconds'] * 1000:.1f} ms"
+        )
+    return df, stats
@@ -0,0 +1,161 @@
+# intent_parser.py
+"""
+Rule-based fast path that turns simple chart requests into Vega-Lite specs
+without calling the model.
+
+A prompt such as "line chart of Number of Visits by Month colored by Site"
+is fully determined by the dataset's columns. parse_intent() reads the chart
+type, the x/y/color fields and an optional aggregate from it, and
+build_spec() fills the matching template (or a plain spec). Anything the
+parser cannot resolve with certainty returns None and goes to the LLM:
+an unknown word, a missing or repeated role, a non-numeric y field, or
+more than one chart type.
+"""
+import copy
+
+from metrics import LOCAL_SPECS, timed
+from semantic_types import apply_field_types
+from spec_cache import STOPWORDS, SYNONYMS, column_matcher, prompt_words
+from utils import deep_merge_dicts
+
+CHART_MARKS = {"bar", "line", "arc", "point", "area"}
+AGGREGATES = {"count", "mean", "sum", "max", "min", "median"}
+X_MARKERS = {"by", "over", "per", "across", "each", "vs", "versus", "against"}
+COLOR_MARKERS = {"color", "hue", "split", "group", "grouped", "stack", "stacked", "segment", "segmented", "breakdown"}
+ROW_WORDS = {"row", "record", "entry", "item", "observation"}
+
+
+def parse_intent(prompt, field_types):
+    """
+    {"mark", "x", "y", "color", "aggregate"} for a prompt that names its chart
+    completely, or None. `field_types` is detect_field_types() of the data.
+    """
+    columns = list(field_types)
+    words = prompt_words(prompt)
+    matcher = column_matcher(columns)
+    intent = {"mark": None, "x": None, "y": None, "color": None, "aggregate": None}
+    pending = None
+    i = 0
+    while i < len(words):
+        column, consumed = matcher.match(words, i)
+        if column is not None:
+            role = pending
+            if role is None:
+                role = "y" if intent["y"] is None else "x"
+            if intent[role] is not None:
+                return None
+            intent[role] = column
+            pending = None
+            i += consumed
+            continue
+        word = SYNONYMS.get(words[i], words[i])
+        i += 1
+        if word in CHART_MARKS:
+            if intent["mark"] not in (None, word):
+                return None
+            intent["mark"] = word
+        elif word in AGGREGATES:
+            if intent["aggregate"] not in (None, word):
+                return None
+            intent["aggregate"] = word
+        elif word in COLOR_MARKERS:
+            pending = "color"
+        elif word in X_MARKERS:
+            if pending != "color":  # "colored by Site"
+                pending = "x"
+        elif word not in STOPWORDS and word not in ROW_WORDS:
+            return None
+    return _validate(intent, field_types)
+
+
+def _validate(intent, field_types):
+    if intent["mark"] is None:
+        return None
+    if intent["x"] is None and intent["mark"] == "line":
+        # "Visits over time" names no x field; use the only temporal column if there is one.
+        temporal = [name for name, info in field_types.items() if info["type"] == "temporal"]
+        if len(temporal) == 1 and temporal[0] != intent["y"]:
+            intent["x"] = temporal[0]
+    if intent["x"] is None:
+        return None
+    if intent["y"] is None:
+        if intent["aggregate"] != "count":
+            return None
+    elif field_types[intent["y"]]["type"] != "quantitative" or intent["aggregate"] == "count":
+        return None
+    fields = [intent[role] for role in ("x", "y", "color") if intent[role] is not None]
+    if len(set(fields)) < len(fields):
+        return None
+    if intent["mark"] == "arc":
+        if intent["color"] is not None:
+            return None
+        intent["aggregate"] = intent["aggregate"] or "sum"
+    return intent
+
+
+def _field_def(field, field_types, aggregate=None):
+    if field is None:
+        return {"aggregate": "count", "type": "quantitative", "title": "Count"}
+    field_def = {"field": field, "type": field_types[field]["type"]}
+    if aggregate:
+        field_def["aggregate"] = aggregate
+    return field_def
+
+
+def build_spec(intent, field_types, template=None):
+    """A Vega-Lite spec for `intent`, built on `template` when one is given."""
+    x = _field_def(intent["x"], field_types)
+    y = _field_def(intent["y"], field_types, intent["aggregate"])
+    if intent["mark"] == "arc":
+        encoding = {"theta": y, "color": x}
+    else:
+        encoding = {"x": x, "y": y}
+        if intent["color"]:
+            encoding["color"] = _field_def(intent["color"], field_types)
+        elif template is not None and "color" in template.get("encoding", {}) and x["type"] in ("nominal", "ordinal"):
+            encoding["color"] = dict(x)  # the template colors each category
+    tooltip = []
+    for field_def in encoding.values():
+        if field_def not in tooltip:
+            tooltip.append(dict(field_def))
+    encoding["tooltip"] = tooltip
+
+    if template is None:
+        mark = {"type": "line", "point": True} if intent["mark"] == "line" else intent["mark"]
+        spec = {"$schema": "https://vega.github.io/schema/vega-lite/v5.json", "mark": mark, "encoding": encoding}
+    else:
+        spec = copy.deepcopy(template)
+        spec.pop("data", None)
+        template_encoding = spec.get("encoding", {})
+        for channel, field_def in encoding.items():
+            base = template_encoding.get(channel)
+            if isinstance(base, dict):
+                # Keep the template's axis/legend styling, replace what it encodes.
+                base = {key: value for key, value in base.items() if key not in ("field", "type", "aggregate")}
+                field_def = deep_merge_dicts(base, field_def)
+            template_encoding[channel] = field_def
+        for channel in list(template_encoding):
+            if channel not in encoding:
+                del template_encoding[channel]
+        spec["encoding"] = template_encoding
+    return apply_field_types(spec, field_types)
+
+
+@timed("local_spec")
+def local_spec(prompt, field_types, template_for=None):
+    """
+    The spec for `prompt` if the parser resolves it, else None (use the LLM).
+    `template_for(mark)` may return a template to fill; when it returns None
+    for the parsed mark the prompt is left to the LLM as well.
+    """
+    intent = parse_intent(prompt, field_types) if prompt else None
+    template = None
+    if intent is not None and template_for is not None:
+        template = template_for(intent["mark"])
+        if template is None:
+            intent = None
+    if intent is None:
+        LOCAL_SPECS.labels(result="fallback").inc()
+        return None
+    LOCAL_SPECS.labels(result="hit").inc()
+    return build_spec(intent, field_types, template)
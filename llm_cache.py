@@ -0,0 +1,327 @@
+# llm_cache.py
+"""
+Persistent cache of chat-completion replies.
+
+Requests are keyed by a SHA-256 of the canonical JSON of model, temperature,
+max_tokens, messages and (when set) response_format, so a byte-identical
+request (a replayed demo, a regression run, a repeated turn) is answered
+without calling the API. Entries live in SQLite with TTL and LRU eviction;
+replies already seen by this process are served from a bounded in-memory
+LRU. Only replies holding a JSON object are stored: prose, refusals and
+broken JSON are asked for again next time instead of being replayed.
+
+With stream=True a miss is streamed and cut off as soon as the first
+top-level JSON object is followed by more text, so trailing prose is never
+generated. A stream that simply ends after the object is read to the end
+for the usage report.
+
+Prompt tokens the provider served from its prefix cache (see prompt_layout)
+are taken from the usage report, counted in the viz_llm_tokens metric and
+printed with the cache stats.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from dataset_cache import get_cache_dir
+from metrics import LLM_CACHE_LOOKUPS, record_usage, timed
+from openai_client import async_create_with_retries, create_with_retries
+from prompt_summary import count_tokens
+from utils import JsonObjectScanner
+
+DEFAULT_MAX_ENTRIES = 10_000
+DEFAULT_MEMORY_ENTRIES = 256
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+KEY_FIELDS = ("model", "temperature", "max_tokens", "messages")
+STREAM_OPTIONS = {"include_usage": True}  # a final chunk carries the usage, cached tokens included
+
+
+def is_json_object(text):
+    try:
+        return isinstance(json.loads(text), dict)
+    except ValueError:
+        return False
+
+
+def is_cacheable(reply):
+    """Whether `reply` contains a JSON object, the only kind of reply worth replaying."""
+    if not reply:
+        return False
+    scanner = JsonObjectScanner()
+    scanner.feed(reply)
+    return scanner.json_text is not None and is_json_object(scanner.json_text)
+
+
+def request_key(request):
+    """Canonical hash of the fields of `request` that determine the reply."""
+    fields = {field: request.get(field) for field in KEY_FIELDS}
+    if request.get("response_format"):
+        # Only keyed when set, so keys of free-text requests stay as they were.
+        fields["response_format"] = request["response_format"]
+    canonical = json.dumps(
+        fields,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed reply cache with TTL expiry, LRU eviction and hit-rate stats."""
+
+    def __init__(self, path=None, max_entries=None, ttl=None, memory_entries=None):
+        self.path = path or os.path.join(get_cache_dir("llm"), "responses.sqlite")
+        if max_entries is None:
+            max_entries = int(os.getenv("VIZ_LLM_CACHE_ENTRIES", DEFAULT_MAX_ENTRIES))
+        if ttl is None:
+            ttl = float(os.getenv("VIZ_LLM_CACHE_TTL", DEFAULT_TTL_SECONDS))
+        if memory_entries is None:
+            memory_entries = int(os.getenv("VIZ_LLM_CACHE_MEMORY", DEFAULT_MEMORY_ENTRIES))
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (reply, created), least recently used first
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, reply TEXT NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def get(self, key):
+        """Return the cached reply for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and now - cached[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            row = self._db.execute(
+                "SELECT reply, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            # The row is touched once per process; later hits come from memory.
+            self._db.execute(
+                "UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key)
+            )
+            self._remember(key, row)
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, reply):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, reply, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, reply, now, now),
+            )
+            self._remember(key, (reply, now))
+            self._evict(now)
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._memory.clear()
+
+    def stats(self):
+        """Hits, misses and hit rate for this process, plus the number of stored entries."""
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+_default_cache = None
+
+
+def get_response_cache():
+    """The shared cache, or None when VIZ_LLM_CACHE=0 disables it."""
+    global _default_cache
+    if os.getenv("VIZ_LLM_CACHE", "1") == "0":
+        return None
+    if _default_cache is None:
+        _default_cache = ResponseCache()
+    return _default_cache
+
+
+def _streaming_enabled(request):
+    return request.pop("stream", False) and os.getenv("VIZ_LLM_STREAM", "1") != "0"
+
+
+def _chunk_text(chunk):
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+
+_reported_usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+_usage_lock = threading.Lock()
+
+
+def _record_usage(request, reply, usage=None):
+    # Streams cut off before the usage chunk arrives have their tokens estimated.
+    cached_tokens = 0
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with _usage_lock:
+            _reported_usage["requests"] += 1
+            _reported_usage["prompt_tokens"] += prompt_tokens
+            _reported_usage["cached_tokens"] += cached_tokens
+    else:
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in request.get("messages", []))
+        completion_tokens = count_tokens(reply or "")
+    record_usage(request.get("model", "unknown"), prompt_tokens, completion_tokens, cached_tokens)
+
+
+def prompt_cache_stats():
+    """Prompt and provider-cached tokens over the requests whose usage the API reported."""
+    with _usage_lock:
+        stats = dict(_reported_usage)
+    stats["cached_rate"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+    return stats
+
+
+def _read_stream(chunk, scanner, state):
+    """Feed one chunk; True once the reader should stop."""
+    state["usage"] = getattr(chunk, "usage", None) or state["usage"]
+    text = _chunk_text(chunk)
+    if not text:
+        return False
+    if state["closed"]:
+        return True  # the spec is complete; drop whatever the model adds after it
+    state["closed"] = scanner.feed(text)
+    return False
+
+
+def _complete(client, request, stream):
+    with timed("llm_request"):
+        if not stream:
+            response = create_with_retries(client, **request)
+            reply = response.choices[0].message.content
+            _record_usage(request, reply, getattr(response, "usage", None))
+            return reply
+        scanner = JsonObjectScanner()
+        state = {"closed": False, "usage": None}
+        response = create_with_retries(client, stream=True, stream_options=STREAM_OPTIONS, **request)
+        try:
+            for chunk in response:
+                if _read_stream(chunk, scanner, state):
+                    break
+        finally:
+            response.close()
+    _record_usage(request, scanner.text, state["usage"])
+    return scanner.text
+
+
+async def _complete_async(client, request, stream):
+    with timed("llm_request"):
+        if not stream:
+            response = await async_create_with_retries(client, **request)
+            reply = response.choices[0].message.content
+            _record_usage(request, reply, getattr(response, "usage", None))
+            return reply
+        scanner = JsonObjectScanner()
+        state = {"closed": False, "usage": None}
+        response = await async_create_with_retries(client, stream=True, stream_options=STREAM_OPTIONS, **request)
+        try:
+            async for chunk in response:
+                if _read_stream(chunk, scanner, state):
+                    break
+        finally:
+            await response.close()
+    _record_usage(request, scanner.text, state["usage"])
+    return scanner.text
+
+
+def cached_chat_completion(client, cache=None, **request):
+    """
+    client.chat.completions.create(**request).choices[0].message.content,
+    answered from the response cache when the same request was seen before
+    and retried on transient errors otherwise.
+    Pass stream=True to stop reading the reply once its JSON object closes.
+    """
+    stream = _streaming_enabled(request)
+    cache = cache or get_response_cache()
+    if cache is None:
+        return _complete(client, request, stream)
+    key = request_key(request)
+    reply = cache.get(key)
+    LLM_CACHE_LOOKUPS.labels(result="miss" if reply is None else "hit").inc()
+    if reply is None:
+        reply = _complete(client, request, stream)
+        if is_cacheable(reply):
+            cache.put(key, reply)
+    return reply
+
+
+async def async_cached_chat_completion(client, cache=None, **request):
+    """cached_chat_completion for an openai.AsyncOpenAI client."""
+    stream = _streaming_enabled(request)
+    cache = cache or get_response_cache()
+    if cache is None:
+        return await _complete_async(client, request, stream)
+    key = request_key(request)
+    reply = cache.get(key)
+    LLM_CACHE_LOOKUPS.labels(result="miss" if reply is None else "hit").inc()
+    if reply is None:
+        reply = await _complete_async(client, request, stream)
+        if is_cacheable(reply):
+            cache.put(key, reply)
+    return reply
+
+
+def format_cache_stats(stats):
+    return (
+        f"LLM cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries stored"
+    )
+
+
+def format_prompt_cache_stats(stats):
+    return (
+        f"Provider prompt cache: {stats['cached_tokens']} of {stats['prompt_tokens']} prompt tokens cached "
+        f"({stats['cached_rate']:.0%}) over {stats['requests']} requests"
+    )
+
+
+def print_cache_stats():
+    cache = get_response_cache()
+    if cache is not None:
+        print(format_cache_stats(cache.stats()))
+    stats = prompt_cache_stats()
+    if stats["requests"]:
+        print(format_prompt_cache_stats(stats))
@@ -0,0 +1,385 @@
+# llm_server.py
+"""
+Local OpenAI-compatible chat-completions server for offline runs and benchmarks.
+
+Modes:
+    mock    answer from the recordings when a request was recorded, otherwise
+            with a deterministic reply built from the prompt (a Vega-Lite spec,
+            a Chart.js config, or main.py's recommendation/customization JSON)
+    replay  answer only from the recordings; unrecorded requests get a 404
+    record  forward each request to the real API, save the reply, return it
+
+Point the scripts at it with VIZ_LLM_BASE_URL; no API key is needed then:
+
+    python llm_server.py --mode mock --latency 0.8 --chunk-delay 0.01
+    VIZ_LLM_BASE_URL=http://127.0.0.1:8765/v1 python vega-lite-llm.py
+
+Recordings are JSONL (one request/response pair per line) at --recordings,
+default <VIZ_CACHE_DIR>/llm/recordings.jsonl. Requests are matched with the
+key of the response cache (model, temperature, max_tokens, messages and
+response_format) plus `n`, so a one-choice recording never answers a
+speculative n>1 request or the other way round.
+Set VIZ_LLM_CACHE=0 on the client when the server should see every request.
+--invalid-rate makes a fraction of mock replies broken JSON, and mock mode
+honours `n`, for exercising speculative generation (speculative.py).
+Mock replies report simulated provider prompt caching (PrefixCache) in
+usage.prompt_tokens_details.cached_tokens, so prompt layouts can be compared
+offline.
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+from dataset_cache import get_cache_dir
+from llm_cache import request_key
+from openai_client import create_with_retries
+from prompt_summary import count_tokens
+from utils import get_openai_api_key
+
+DEFAULT_PORT = 8765
+DEFAULT_UPSTREAM = "https://api.openai.com/v1"
+CHUNK_CHARS = 16
+MODES = ("mock", "replay", "record")
+SAMPLE_MARKER = "Here is a sample of the data:\n"
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+
+def _columns(messages):
+    """Column names mentioned in the prompt ("Columns: a, b" or main.py's list repr)."""
+    for message in messages:
+        content = message.get("content") or ""
+        match = re.search(r"^\s*Columns: (\[.*\])\s*$", content, re.M)
+        if match:
+            try:
+                return [str(column) for column in ast.literal_eval(match.group(1))]
+            except (ValueError, SyntaxError):
+                pass
+        match = re.search(r"^Columns: (.+)$", content, re.M)
+        if match:
+            return [column.strip() for column in match.group(1).split(",") if column.strip()]
+    return []
+
+
+def _numeric_columns(messages):
+    """Columns holding numbers in the data sample sent with the prompt, if there is one."""
+    for message in messages:
+        content = message.get("content") or ""
+        marker = content.find(SAMPLE_MARKER)
+        if marker != -1:
+            try:
+                records, _ = json.JSONDecoder().raw_decode(content, marker + len(SAMPLE_MARKER))
+            except ValueError:
+                return set()
+            return {
+                column
+                for record in records[:1]
+                for column, value in record.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            }
+    return set()
+
+
+def mock_reply(messages):
+    """A deterministic reply of the shape the calling prompt asks for."""
+    prompt = "\n".join(message.get("content") or "" for message in messages if message.get("role") == "system")
+    columns = _columns(messages) or ["category", "value"]
+    numeric = _numeric_columns(messages)
+    # Prefer a categorical x and a numeric y when the sample says which is which.
+    x_column = next((column for column in columns if column not in numeric), columns[0])
+    y_column = next((column for column in columns if column in numeric and column != x_column), columns[-1])
+    if "visualization customization" in prompt:
+        reply = {"interactive": True, "x_axis_label": x_column, "y_axis_label": y_column}
+    elif '"chart_type"' in prompt:
+        reply = {
+            "chart_type": "bar",
+            "x_column": x_column,
+            "y_column": y_column,
+            "transformations": {},
+            "rationale": "Mock recommendation.",
+        }
+    elif "Chart.js" in prompt:
+        reply = {
+            "type": "bar",
+            "data": {
+                "labels": ["A", "B", "C"],
+                "datasets": [{"label": y_column, "data": [3, 1, 2]}],
+            },
+            "options": {"responsive": True},
+        }
+    else:
+        reply = {
+            "mark": "bar",
+            "encoding": {
+                "x": {"field": x_column, "type": "nominal"},
+                "y": {"field": y_column, "type": "quantitative"},
+            },
+        }
+    return json.dumps(reply, indent=2)
+
+
+class PrefixCache:
+    """
+    Simulates the provider's prompt caching for mock replies: the longest run of
+    leading messages seen in an earlier request counts as cached when it is at
+    least CACHE_MIN_TOKENS long, rounded down to CACHE_STEP_TOKENS. (The real
+    cache works on tokens, not whole messages, so this slightly undercounts.)
+    """
+
+    def __init__(self):
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, messages):
+        """(prompt tokens, cached tokens) for `messages`, remembering their prefixes."""
+        digest = hashlib.sha256()
+        prefixes, tokens, cached = [], 0, 0
+        with self._lock:
+            for message in messages:
+                digest.update(json.dumps(message, sort_keys=True).encode())
+                prefix = digest.hexdigest()
+                tokens += count_tokens(message.get("content") or "")
+                if prefix in self._seen:
+                    cached = tokens
+                prefixes.append(prefix)
+            self._seen.update(prefixes)
+        if cached < CACHE_MIN_TOKENS:
+            cached = 0
+        return tokens, cached - cached % CACHE_STEP_TOKENS
+
+
+def completion(model, contents, prompt_tokens=0, cached_tokens=0):
+    """A chat.completion object in the API's JSON shape, one choice per item of `contents`."""
+    completion_tokens = sum(count_tokens(content) for content in contents)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+            for index, content in enumerate(contents)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+def recording_key(request):
+    """request_key() plus the number of choices; n=1 keeps the plain key of older recordings."""
+    key = request_key(request)
+    n = request.get("n") or 1
+    return key if n == 1 else f"{key}-n{n}"
+
+
+class Recordings:
+    """Request/response pairs kept in memory and appended to a JSONL file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._responses = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._responses[entry["key"]] = entry["response"]
+
+    def get(self, key):
+        return self._responses.get(key)
+
+    def add(self, key, request, response):
+        with self._lock:
+            self._responses[key] = response
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"key": key, "request": request, "response": response}) + "\n")
+
+    def __len__(self):
+        return len(self._responses)
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so pooled clients reuse connections
+    disable_nagle_algorithm = True  # streamed chunks are small; don't hold them back
+    server_version = "viz-llm-server"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {"error": {"message": message, "type": "invalid_request_error"}})
+
+    def _send_stream(self, response, include_usage=False):
+        base = {
+            "id": response["id"],
+            "object": "chat.completion.chunk",
+            "created": response["created"],
+            "model": response["model"],
+        }
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        # With n > 1 the choices are generated side by side: each round sends the
+        # next piece of every choice, and the chunk delay applies per round.
+        streams = []
+        for choice in response["choices"]:
+            content = choice["message"]["content"] or ""
+            pieces = [content[i : i + CHUNK_CHARS] for i in range(0, len(content), CHUNK_CHARS)]
+            events = [{"index": choice["index"], "delta": {"role": "assistant", "content": piece}, "finish_reason": None}
+                      for piece in pieces]
+            events.append({"index": choice["index"], "delta": {}, "finish_reason": "stop"})
+            streams.append(events)
+        rounds = [
+            [dict(base, choices=[stream[i]]) for stream in streams if i < len(stream)]
+            for i in range(max(map(len, streams), default=0))
+        ]
+        if include_usage and response.get("usage"):
+            rounds.append([dict(base, choices=[], usage=response["usage"])])
+        try:
+            for chunks in rounds:
+                for chunk in chunks:
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                if self.server.chunk_delay:
+                    time.sleep(self.server.chunk_delay)
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the client stopped reading once its JSON closed
+
+    def _write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path.rstrip("/").split("/")[-2:] != ["chat", "completions"]:
+            self._send_error(404, f"Unknown endpoint {self.path}")
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        stream = request.pop("stream", False)
+        include_usage = (request.pop("stream_options", None) or {}).get("include_usage", False)
+        key = recording_key(request)
+        response = self.server.recordings.get(key)
+        if response is None:
+            if self.server.mode == "replay":
+                self._send_error(404, "No recorded response for this request")
+                return
+            if self.server.mode == "record":
+                try:
+                    response = self.server.forward(request)
+                except Exception as e:
+                    self._send_error(502, f"Upstream request failed: {e}")
+                    return
+                self.server.recordings.add(key, request, response)
+            else:
+                messages = request.get("messages", [])
+                prompt_tokens, cached_tokens = self.server.prefix_cache.lookup(messages)
+                contents = [self.server.mock_content(messages) for _ in range(request.get("n") or 1)]
+                response = completion(request.get("model", "mock"), contents, prompt_tokens, cached_tokens)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if stream:
+            self._send_stream(response, include_usage)
+        else:
+            self._send_json(200, response)
+
+
+class LLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mode="mock", recordings_path=None, latency=0.0, chunk_delay=0.0,
+                 upstream=DEFAULT_UPSTREAM, verbose=False, invalid_rate=0.0):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode '{mode}'; use one of {', '.join(MODES)}")
+        super().__init__(address, ChatCompletionsHandler)
+        self.mode = mode
+        self.recordings = Recordings(recordings_path or os.path.join(get_cache_dir("llm"), "recordings.jsonl"))
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.verbose = verbose
+        self.prefix_cache = PrefixCache()
+        self.invalid_rate = invalid_rate
+        self._random = random.Random(0)
+        self._upstream = None
+        self._upstream_url = upstream
+
+    def mock_content(self, messages):
+        """mock_reply(), cut off mid-object for a fraction `invalid_rate` of replies."""
+        content = mock_reply(messages)
+        if self.invalid_rate and self._random.random() < self.invalid_rate:
+            content = content[: len(content) // 2]
+        return content
+
+    def forward(self, request):
+        if self._upstream is None:
+            self._upstream = openai.OpenAI(api_key=get_openai_api_key(), base_url=self._upstream_url)
+        return create_with_retries(self._upstream, **request).model_dump(exclude_unset=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible server with record/replay.")
+    parser.add_argument("--mode", choices=MODES, default="mock")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--recordings", help="JSONL file of recorded request/response pairs")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response starts")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--upstream", default=DEFAULT_UPSTREAM, help="API base URL used in record mode")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="fraction of mock replies sent as broken JSON")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    server = LLMServer(
+        (args.host, args.port),
+        mode=args.mode,
+        recordings_path=args.recordings,
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        upstream=args.upstream,
+        verbose=args.verbose,
+        invalid_rate=args.invalid_rate,
+    )
+    print(
+        f"Serving {args.mode} chat completions on http://{args.host}:{args.port}/v1 "
+        f"({len(server.recordings)} recorded responses from {server.recordings.path})"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,61 @@
-import openai
+import asyncio
 import altair as alt
-import pandas as pd
 import json
 import re
-from utils import get_openai_api_key, display_chart
+import time
+from utils import display_chart, optimize_dataframe
+from dataset_cache import read_csv_cached
+from http_fetch import fetch_csv
+from llm_cache import async_cached_chat_completion, print_cache_stats
+from openai_client import get_async_client
+from conversation import get_history
+from metrics import JSON_PARSE_FAILURES, TIME_TO_CHART_SECONDS
+from structured_output import (
+    CUSTOMIZATION_SCHEMA,
+    parse_structured,
+    recommendation_schema,
+    structured_output_enabled,
+    structured_request,
+)
 import os
 import tempfile
 import webbrowser
 
-conversation_history = []
-client = openai.OpenAI(api_key=get_openai_api_key())
+LLM_CALL_TIMEOUT = float(os.getenv("VIZ_LLM_TIMEOUT", 60))
 
+_event_loop = None
 
-def extract_customization_details(user_prompt):
+
+def _get_event_loop():
+    # One loop for the whole session so the async client's connections are reused.
+    global _event_loop
+    if _event_loop is None:
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop
+
+
+def _parse_json_reply(gpt_reply):
     """
-    Extract customization details for the chart based on the user's description.
-    This focuses solely on customization aspects like color, interactivity, etc.
+    Pull the JSON object out of a reply, preferring a ```json fenced block.
+    In structured-output mode the reply is the object itself.
     """
+    if structured_output_enabled():
+        return parse_structured(gpt_reply)
+    json_match = re.search(r"```json\s*({.*?})\s*```", gpt_reply, re.DOTALL)
+    if not json_match:
+        json_match = re.search(r"(\{.*\})", gpt_reply, re.DOTALL)
+    if not json_match:
+        JSON_PARSE_FAILURES.labels(reason="no_json_object").inc()
+        raise ValueError("reply contained no JSON object")
+    try:
+        return json.loads(json_match.group(1))
+    except json.JSONDecodeError:
+        JSON_PARSE_FAILURES.labels(reason="invalid_json").inc()
+        raise
+
 
+def customization_prompt(user_prompt):
+    """System prompt and user message for the customization request."""
     system_prompt = """
     You are an expert in data visualization customization. A user will describe how they would like to customize a chart.
     Based on the user's description, extract the following customization details:
@@ -36,47 +74,15 @@ def extract_customization_details(user_prompt):
     }
     """
 
-    try:
-        conversation_history.append(
-            {"role": "system", "content": system_prompt}
-        )  # Add system prompt to the conversation history
-        conversation_history.append({"role": "user", "content": user_prompt})
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=conversation_history,
-            temperature=0.3,
-            max_tokens=1000,
-        )
-
-        gpt_recommendation = response.choices[0].message.content
-        json_match = re.search(
-            r"```json\s*({.*?})\s*```", gpt_recommendation, re.DOTALL
-        )
-        if json_match:
-            customization_details = json.loads(json_match.group(1))
-        else:
-            customization_details = json.loads(
-                re.search(r"\{.*\}", gpt_recommendation, re.DOTALL).group(0)
-            )
-
-        conversation_history.append(
-            {"role": "assistant", "content": gpt_recommendation}
-        )
-
-        return customization_details
+    return system_prompt, user_prompt
 
-    except Exception as e:
-        print(f"Error extracting customizations: {e}")
-        return {}
 
-
-def analyze_data_and_create_chart(df, user_prompt):
+def recommendation_prompt(df, user_prompt):
     """
-    Analyze the data and generate a chart type recommendation based on the dataset and the user's goal.
-    This will focus on the best chart type selection, columns to plot, etc.
+    System prompt, user message and dataset context for the chart recommendation
+    request. The dataset details are the same on every turn, so they go in the
+    context ahead of the history instead of in the user message.
     """
-
     columns = list(df.columns)
     data_preview = df.head().to_string()
     data_info = df.dtypes.to_string()
@@ -106,7 +112,7 @@ def analyze_data_and_create_chart(df, user_prompt):
     }
     """
 
-    user_prompt_with_data = f"""
+    dataset_details = f"""
     Dataset Details:
     Columns: {columns}
     Data Preview:
@@ -114,49 +120,88 @@ def analyze_data_and_create_chart(df, user_prompt):
     
     Column Types:
     {data_info}
+    """
 
+    user_prompt_with_goal = f"""
     User Context/Goal: {user_prompt}
 
     Provide a detailed recommendation on the most appropriate chart and any necessary transformations.
     """
 
-    try:
-        # Add system prompt and user prompt to conversation history
-        conversation_history.append(
-            {"role": "system", "content": system_prompt}
-        )
-        conversation_history.append({"role": "user", "content": user_prompt_with_data})
+    return system_prompt, user_prompt_with_goal, dataset_details
 
-        # Get model response for chart recommendation
-        response = client.chat.completions.create(
+
+def _histories(dataset_key):
+    # Customization and recommendation requests keep separate threads per dataset.
+    return get_history((dataset_key, "customization")), get_history((dataset_key, "recommendation"))
+
+
+async def _ask_gpt(messages, temperature, **extra):
+    return await asyncio.wait_for(
+        async_cached_chat_completion(
+            get_async_client(),
             model="gpt-4o",
-            messages=conversation_history,
-            temperature=0.2,
+            messages=messages,
+            temperature=temperature,
             max_tokens=1000,
-        )
-
-        # Extract JSON response from the model
-        gpt_recommendation = response.choices[0].message.content
-        json_match = re.search(
-            r"```json\s*({.*?})\s*```", gpt_recommendation, re.DOTALL
-        )
-        if json_match:
-            recommendation = json.loads(json_match.group(1))
-        else:
-            recommendation = json.loads(
-                re.search(r"\{.*\}", gpt_recommendation, re.DOTALL).group(0)
-            )
+            stream=True,
+            **extra,
+        ),
+        timeout=LLM_CALL_TIMEOUT,
+    )
 
-        # Add assistant's response to conversation history
-        conversation_history.append(
-            {"role": "assistant", "content": gpt_recommendation}
-        )
 
-        return recommendation
+def _error_text(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return f"timed out after {LLM_CALL_TIMEOUT:g}s"
+    return str(error)
+
+
+async def _customizations_and_recommendation(df, user_prompt, dataset_key):
+    # The two requests use separate histories, so neither waits on the other.
+    custom_history, chart_history = _histories(dataset_key)
+    custom_reply, chart_reply = await asyncio.gather(
+        _ask_gpt(
+            custom_history.build(*customization_prompt(user_prompt)),
+            0.3,
+            **structured_request("customizations", CUSTOMIZATION_SCHEMA),
+        ),
+        _ask_gpt(
+            chart_history.build(*recommendation_prompt(df, user_prompt)),
+            0.2,
+            **structured_request("chart_recommendation", recommendation_schema(df.columns)),
+        ),
+        return_exceptions=True,
+    )
 
+    customizations, recommendation = {}, None
+    try:
+        if isinstance(custom_reply, BaseException):
+            raise custom_reply
+        customizations = _parse_json_reply(custom_reply)
+        custom_history.record(user_prompt, custom_reply)
     except Exception as e:
-        print(f"Error in chart generation: {e}")
-        return None
+        print(f"Error extracting customizations: {_error_text(e)}")
+    try:
+        if isinstance(chart_reply, BaseException):
+            raise chart_reply
+        recommendation = _parse_json_reply(chart_reply)
+        chart_history.record(user_prompt, chart_reply)
+    except Exception as e:
+        print(f"Error in chart generation: {_error_text(e)}")
+    return customizations, recommendation
+
+
+def get_customizations_and_recommendation(df, user_prompt, dataset_key=None):
+    """
+    Run the customization and chart recommendation requests concurrently,
+    each bounded by LLM_CALL_TIMEOUT. Returns (customizations, recommendation)
+    in about the time of the slower one; either is {} / None when its
+    request fails.
+    """
+    return _get_event_loop().run_until_complete(
+        _customizations_and_recommendation(df, user_prompt, dataset_key)
+    )
 
 
 def apply_customizations_and_create_chart(df, recommendation, customizations):
@@ -278,12 +323,15 @@ def main():
             ).strip()
 
             if data_source_choice == "1":
-                csv_path = input("Enter the path to your CSV file: ").strip()
-                df = pd.read_csv(csv_path)
+                csv_path = input("Enter the path to your CSV file (or a directory or glob of CSV files): ").strip()
+                df = read_csv_cached(csv_path, optimize=True)
+                dataset_key = os.path.abspath(csv_path)
 
             elif data_source_choice == "2":
                 csv_url = input("Enter the URL of the CSV file: ").strip()
-                df = pd.read_csv(csv_url)
+                df, _ = fetch_csv(csv_url)
+                df = optimize_dataframe(df)
+                dataset_key = csv_url
 
             # elif data_source_choice == "3":
             #     user_prompt = input("Describe the chart you want: ").strip()
@@ -296,13 +344,16 @@ def main():
 
             else:
                 print("Invalid choice. Exiting.")
+                print_cache_stats()
                 break
 
             user_prompt = input(
                 "Describe the insight or analysis you want from this data: "
             ).strip()
-            customizations = extract_customization_details(user_prompt)
-            recommendation = analyze_data_and_create_chart(df, user_prompt)
+            turn_start = time.perf_counter()
+            customizations, recommendation = get_customizations_and_recommendation(
+                df, user_prompt, dataset_key
+            )
 
             if recommendation:
                 chart = apply_customizations_and_create_chart(
@@ -310,6 +361,7 @@ def main():
                 )
                 if chart:
                     display_chart(chart)
+                    TIME_TO_CHART_SECONDS.labels(entry_point="main").observe(time.perf_counter() - turn_start)
 
         except Exception as e:
             print(f"Error: {e}")
@@ -325,14 +377,17 @@ def main():
             if follow_up_prompt != "yes":
                 break
             user_prompt = input("Please provide the modification details: ").strip()
-            customizations = extract_customization_details(user_prompt)
-            recommendation = analyze_data_and_create_chart(df, user_prompt)
+            turn_start = time.perf_counter()
+            customizations, recommendation = get_customizations_and_recommendation(
+                df, user_prompt, dataset_key
+            )
             if recommendation:
                 chart = apply_customizations_and_create_chart(
                     df, recommendation, customizations
                 )
                 if chart:
                     display_chart(chart)
+                    TIME_TO_CHART_SECONDS.labels(entry_point="main").observe(time.perf_counter() - turn_start)
 
 
 if __name__ == "__main__":
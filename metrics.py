@@ -0,0 +1,106 @@
+# metrics.py
+"""
+Prometheus metrics for the chart pipeline.
+
+Set VIZ_METRICS_PORT to serve them on http://127.0.0.1:<port>/metrics while
+a session runs, and/or VIZ_METRICS_FILE to write them in the text exposition
+format when the process exits. With neither set they are only kept in memory.
+"""
+import atexit
+import os
+
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server, write_to_textfile
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "viz_stage_seconds",
+    "Time spent in each pipeline stage.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+TIME_TO_CHART_SECONDS = Histogram(
+    "viz_time_to_chart_seconds",
+    "From the user's request to the chart being written or displayed.",
+    ["entry_point"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "viz_llm_tokens",
+    "Tokens sent to and generated by the model (estimated when the API reports no usage);"
+    " cached_prompt counts prompt tokens the provider served from its prefix cache.",
+    ["model", "kind"],
+)
+LLM_CACHE_LOOKUPS = Counter(
+    "viz_llm_cache_lookups",
+    "Response cache lookups.",
+    ["result"],
+)
+SPEC_CACHE_LOOKUPS = Counter(
+    "viz_spec_cache_lookups",
+    "Near-duplicate spec cache lookups (exact, similar or miss).",
+    ["result"],
+)
+LOCAL_SPECS = Counter(
+    "viz_local_specs",
+    "Prompts answered by the rule-based parser (hit) or passed on to the LLM (fallback).",
+    ["result"],
+)
+SPECULATIVE_REQUESTS = Counter(
+    "viz_speculative_requests",
+    "Multi-candidate requests by outcome: first_valid, saved (an earlier candidate was invalid) or all_invalid.",
+    ["result"],
+)
+SPECULATIVE_EXTRA_TOKENS = Counter(
+    "viz_speculative_extra_tokens",
+    "Estimated completion tokens generated for candidates that were not used.",
+)
+JSON_PARSE_FAILURES = Counter(
+    "viz_json_parse_failures",
+    "Model replies that did not yield a usable JSON object.",
+    ["reason"],
+)
+BYTES_WRITTEN = Counter(
+    "viz_output_bytes_written",
+    "Bytes written to chart output files.",
+)
+
+
+def timed(stage):
+    """Decorator or context manager recording the duration of `stage`."""
+    return STAGE_SECONDS.labels(stage=stage).time()
+
+
+def record_usage(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    LLM_TOKENS.labels(model=model, kind="prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(model=model, kind="completion").inc(completion_tokens)
+    LLM_TOKENS.labels(model=model, kind="cached_prompt").inc(cached_tokens)
+
+
+def write_output(path, content, mode="w"):
+    """Write `content` to `path` and count the bytes."""
+    data = content.encode("utf-8")
+    with open(path, mode + "b") as f:
+        f.write(data)
+    BYTES_WRITTEN.inc(len(data))
+
+
+_started = False
+
+
+def start_metrics():
+    """Start the endpoint and/or exit-time dump configured in the environment (once)."""
+    global _started
+    if _started:
+        return
+    _started = True
+    port = os.getenv("VIZ_METRICS_PORT")
+    if port:
+        start_http_server(int(port), addr="127.0.0.1")
+    path = os.getenv("VIZ_METRICS_FILE")
+    if path:
+        atexit.register(write_to_textfile, path, REGISTRY)
+
+
+# Every entry point imports this module, so exporting is configured on import.
+start_metrics()
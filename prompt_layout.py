@@ -0,0 +1,33 @@
+# prompt_layout.py
+"""
+Cache-friendly message layout.
+
+Providers reuse the longest prefix of a request they have recently seen
+(OpenAI caches from 1024 tokens on, in 128-token steps), which cuts both
+latency and the price of those tokens. Every request is therefore laid out
+from the most static content to the most dynamic:
+
+1. instructions     the same for every dataset and every turn
+2. dataset context  the same for every turn on one dataset
+3. conversation     earlier turns, then the new request
+
+Each of the first two blocks is a single system message whose text is
+rendered deterministically (memoized summaries and JSON), so the prefix is
+byte-identical from one request to the next. Nothing dataset- or
+turn-specific may go into the instructions, and nothing turn-specific into
+the context. The cached-token counts the API reports are counted by
+llm_cache and printed with its stats.
+"""
+
+
+def system_message(parts):
+    """One system message joining `parts` (strings) with blank lines."""
+    return {"role": "system", "content": "\n\n".join(parts)}
+
+
+def build_messages(instructions, context=(), conversation=()):
+    """Messages in cache-friendly order: instructions, dataset context, then the conversation."""
+    messages = [system_message(instructions)]
+    if context:
+        messages.append(system_message(context))
+    return messages + list(conversation)
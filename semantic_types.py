@@ -0,0 +1,196 @@
+# semantic_types.py
+"""
+Vectorized detection of Vega-Lite field types.
+
+Each column is classified as temporal, quantitative, ordinal, nominal or
+geographic using whole-column pandas/NumPy operations only. The result is
+used both in the prompt (so the model picks the right encoding type) and to
+correct the encoding types of the spec the model returns.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+MONTHS = [
+    "january", "february", "march", "april", "may", "june",
+    "july", "august", "september", "october", "november", "december",
+]
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+ORDERED_VOCABULARIES = [
+    MONTHS,
+    [month[:3] for month in MONTHS],
+    WEEKDAYS,
+    [day[:3] for day in WEEKDAYS],
+    ["q1", "q2", "q3", "q4"],
+    ["low", "medium", "high"],
+    ["small", "medium", "large"],
+]
+ISO_DATE_PATTERN = r"\d{4}-\d{2}(?:-\d{2})?(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?(?:Z|[+-]\d{2}:?\d{2})?$"
+LATITUDE_NAMES = re.compile(r"(^|[^a-z])(lat|latitude)([^a-z]|$)", re.IGNORECASE)
+LONGITUDE_NAMES = re.compile(r"(^|[^a-z])(lon|lng|long|longitude)([^a-z]|$)", re.IGNORECASE)
+GEO_NAMES = re.compile(
+    r"(^|[^a-z])(country|state|province|region|city|county|zip|zipcode|postcode)([^a-z]|$)",
+    re.IGNORECASE,
+)
+TIME_NAMES = re.compile(r"(date|time|year|month|period)", re.IGNORECASE)
+IDENTIFIER_NAMES = re.compile(r"^(no|id|index|#)$|(^|[^a-z])id$", re.IGNORECASE)
+NUMBER_PATTERN = r"[+-]?\d+(?:[.,]\d+)?$"
+DATE_SAMPLE_SIZE = 500
+TYPE_SAMPLE_SIZE = 1000
+
+
+def _fractional_year_expr(field):
+    # 2013.250 means March 2013: the fraction counts months out of twelve.
+    ref = f"datum[{field!r}]"
+    return f"datetime(floor({ref}), round(({ref} % 1) * 12) - 1, 1)"
+
+
+def _numeric_type(name, values):
+    """Classify a numeric column (NaNs already dropped)."""
+    low, high = values.min(), values.max()
+    if LATITUDE_NAMES.search(name) and -90 <= low and high <= 90:
+        return {"type": "quantitative", "semantic": "geographic", "channel": "latitude"}
+    if LONGITUDE_NAMES.search(name) and -180 <= low and high <= 180:
+        return {"type": "quantitative", "semantic": "geographic", "channel": "longitude"}
+
+    fraction = np.modf(values)[0]
+    if 1800 <= low and high <= 2100 and TIME_NAMES.search(name):
+        if not fraction.any():
+            return {
+                "type": "temporal",
+                "semantic": "year",
+                "calculate": f"datetime(datum[{name!r}], 0, 1)",
+            }
+        months = fraction * 12
+        if np.all(np.abs(months - np.round(months)) < 0.02):
+            return {
+                "type": "temporal",
+                "semantic": "fractional year",
+                "calculate": _fractional_year_expr(name),
+            }
+
+    if IDENTIFIER_NAMES.search(name) and not fraction.any():
+        steps = np.diff(values)
+        if len(values) > 1 and np.all(steps == steps[0]) and steps[0] != 0:
+            return {"type": "ordinal", "semantic": "identifier"}
+    return {"type": "quantitative"}
+
+
+def _string_type(name, distinct):
+    """Classify a string column from its distinct (non-null) values, an Index."""
+    if distinct.str.match(ISO_DATE_PATTERN).all():
+        return {"type": "temporal"}
+    lowered = distinct.str.lower().str.strip()
+    for vocabulary in ORDERED_VOCABULARIES:
+        if lowered.isin(vocabulary).all():
+            rank = {value: position for position, value in enumerate(vocabulary)}
+            order = sorted(range(len(distinct)), key=lambda i: rank[lowered[i]])
+            return {"type": "ordinal", "sort": [distinct[i] for i in order]}
+    if _parseable_dates(distinct):
+        return {"type": "temporal"}
+    if GEO_NAMES.search(name):
+        return {"type": "nominal", "semantic": "geographic"}
+    return {"type": "nominal"}
+
+
+def _parseable_dates(distinct):
+    """Whether (a sample of) the distinct values are all dates such as "April 2023" or "03/15/2023"."""
+    sample = distinct[:DATE_SAMPLE_SIZE]
+    # Every value needs a digit and must not be a plain number ("2023" stays as it is).
+    if not (sample.str.contains(r"\d") & ~sample.str.match(NUMBER_PATTERN)).all():
+        return False
+    parsed = pd.to_datetime(pd.Series(sample), errors="coerce", format="mixed")
+    return bool(parsed.notna().all())
+
+
+def _is_string_column(series):
+    """Whether the leading (non-null) values, or the categories, are all strings."""
+    values = series.cat.categories if isinstance(series.dtype, pd.CategoricalDtype) else series
+    return pd.api.types.infer_dtype(values[:TYPE_SAMPLE_SIZE], skipna=True) == "string"
+
+
+def detect_field_types(df):
+    """
+    Return {column: {"type": <Vega-Lite type>, ...}} for every column of `df`.
+
+    Extra keys: "semantic" (geographic, year, fractional year, identifier),
+    "channel" (latitude/longitude), "calculate" (a Vega expression turning
+    the field into a date) and "sort" (the natural order of ordinal values).
+    """
+    field_types = {}
+    for column in df.columns:
+        name = str(column)
+        series = df[column].dropna()
+        if pd.api.types.is_datetime64_any_dtype(series):
+            info = {"type": "temporal"}
+        elif pd.api.types.is_bool_dtype(series):
+            info = {"type": "nominal"}
+        elif pd.api.types.is_numeric_dtype(series) and len(series):
+            info = _numeric_type(name, series.to_numpy(dtype=np.float64))
+        elif len(series) and _is_string_column(series):
+            # Every check runs on the distinct values, found in one hashing pass.
+            info = _string_type(name, pd.Index(series.unique()).astype(str))
+        else:
+            info = {"type": "nominal"}
+        field_types[name] = info
+    return field_types
+
+
+def _fix_field_def(field_def, field_types, transforms):
+    field = field_def.get("field")
+    info = field_types.get(field) if isinstance(field, str) else None
+    if info is None:
+        return
+    if "calculate" in info:
+        derived = f"{field} (date)"
+        transforms.setdefault(derived, {"calculate": info["calculate"], "as": derived})
+        field_def["field"] = derived
+    if info != {"type": "nominal"}:
+        # Plain nominal is only the fallback, not a detection; keep the model's type then.
+        field_def["type"] = info["type"]
+    if "sort" in info and "sort" not in field_def:
+        field_def["sort"] = info["sort"]
+
+
+def apply_field_types(spec, field_types):
+    """
+    Correct encoding types in a Vega-Lite spec (including layers and
+    concatenations) in place, adding calculate transforms for numeric
+    date columns. Returns the spec.
+    """
+    transforms = {}
+    encoding = spec.get("encoding")
+    if isinstance(encoding, dict):
+        for channel_def in encoding.values():
+            for field_def in channel_def if isinstance(channel_def, list) else [channel_def]:
+                if isinstance(field_def, dict):
+                    _fix_field_def(field_def, field_types, transforms)
+    if transforms:
+        existing = spec.setdefault("transform", [])
+        known = {t.get("as") for t in existing if isinstance(t, dict)}
+        existing.extend(t for name, t in transforms.items() if name not in known)
+    for key in ("layer", "hconcat", "vconcat", "concat"):
+        for child in spec.get(key, []) or []:
+            if isinstance(child, dict):
+                apply_field_types(child, field_types)
+    if isinstance(spec.get("spec"), dict):
+        apply_field_types(spec["spec"], field_types)
+    return spec
+
+
+def describe_field_types(field_types):
+    """One line per column for the prompt, e.g. 'Month: temporal'."""
+    lines = []
+    for name, info in field_types.items():
+        line = f"{name}: {info['type']}"
+        if "semantic" in info:
+            line += f" ({info['semantic']})"
+        if "channel" in info:
+            line += f"; encode with the '{info['channel']}' channel"
+        if "calculate" in info:
+            line += f"; derive a date with the transform calculate \"{info['calculate']}\""
+        if "sort" in info:
+            line += f"; sort order {info['sort']}"
+        lines.append(line)
+    return "\n".join(lines)
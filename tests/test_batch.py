@@ -0,0 +1,33 @@
+import asyncio
+import json
+
+from batch import read_jobs, run_batch
+
+
+def _run(tmp_path, lines):
+    jobs_path = tmp_path / "jobs.jsonl"
+    jobs_path.write_text("\n".join(lines) + "\n")
+    results_path = tmp_path / "results.jsonl"
+    # None of these jobs reaches the LLM, so no client is needed.
+    results = asyncio.run(run_batch(read_jobs(str(jobs_path)), str(results_path), client=object()))
+    recorded = [json.loads(line) for line in results_path.read_text().splitlines()]
+    assert sorted(r["id"] for r in recorded) == sorted(r["id"] for r in results)
+    return {result["id"]: result for result in recorded}
+
+
+def test_unknown_backend_is_a_failed_job(tmp_path):
+    results = _run(tmp_path, [
+        '{"id": "e", "dataset": "sample.csv", "prompt": "bars", "backend": "plotly"}',
+        '{"id": "f", "prompt": "bars"}',
+    ])
+    assert results["e"]["status"] == "error"
+    assert "unknown backend 'plotly'" in results["e"]["error"]
+    assert results["f"] == {"id": "f", "dataset": None, "output": "output-batch-vega-lite.html",
+                            "status": "error", "error": "missing 'dataset'"}
+
+
+def test_malformed_line_is_a_failed_job(tmp_path):
+    results = _run(tmp_path, ['{"id": "a", "dataset": "sample.csv",', "", "[1, 2]"])
+    assert results["1"]["status"] == "error"
+    assert results["1"]["error"].startswith("invalid JSON")
+    assert results["3"]["error"] == "job is not a JSON object"
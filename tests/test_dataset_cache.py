@@ -0,0 +1,45 @@
+import os
+
+import pandas as pd
+import pytest
+
+from dataset_cache import DatasetCache, read_csv_cached
+
+
+def test_round_trip(tmp_path):
+    cache = DatasetCache(str(tmp_path))
+    df = pd.DataFrame({
+        "site": pd.Categorical(["a", "b", "a"]),
+        "month": pd.to_datetime(["2024-01-01", "2024-02-01", "2024-03-01"]),
+        "visits": [1.5, 2.0, 3.25],
+        "note": ["x", float("nan"), "z"],
+    })
+    assert cache.store("key", df)
+    pd.testing.assert_frame_equal(cache.load("key"), df, check_categorical=False)
+
+
+@pytest.mark.parametrize(
+    "column",
+    [
+        pd.Series(pd.to_datetime(["2024-01-01", "2024-02-01"], utc=True)),
+        pd.Series(pd.Categorical(pd.to_datetime(["2024-01-01", "2024-02-01"]))),
+        pd.Series([1, None], dtype="Int64"),
+    ],
+)
+def test_columns_that_cannot_round_trip_are_not_stored(tmp_path, column):
+    cache = DatasetCache(str(tmp_path))
+    assert not cache.store("key", pd.DataFrame({"value": column}))
+    assert cache.load("key") is None
+    assert [name for name in os.listdir(tmp_path) if name != "index.json"] == []
+
+
+def test_read_csv_cached_survives_a_failing_store(tmp_path, monkeypatch):
+    path = tmp_path / "data.csv"
+    path.write_text("a,b\n1,x\n2,y\n")
+    cache = DatasetCache(str(tmp_path / "cache"))
+
+    def store(key, df):
+        raise TypeError("Object of type Timestamp is not JSON serializable")
+
+    monkeypatch.setattr(cache, "store", store)
+    assert read_csv_cached(str(path), cache=cache)["a"].tolist() == [1, 2]
@@ -0,0 +1,12 @@
+from llm_server import recording_key
+
+
+def test_recording_key_covers_n_and_response_format():
+    request = {"model": "gpt-4o", "temperature": 0.3, "max_tokens": 100, "messages": [{"role": "user", "content": "x"}]}
+    keys = {
+        recording_key(request),
+        recording_key({**request, "n": 3}),
+        recording_key({**request, "response_format": {"type": "json_object"}}),
+    }
+    assert len(keys) == 3
+    assert recording_key({**request, "n": 1}) == recording_key(request)
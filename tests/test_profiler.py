@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from profiler import profile_dataframe
+
+
+def test_top_value_count_is_exact_below_the_limit():
+    rng = np.random.default_rng(0)
+    sites = np.array([f"site{i}" for i in range(500)], dtype=object)
+    df = pd.DataFrame({"site": sites[rng.integers(0, 500, 200_000)]})
+    expected = df["site"].value_counts()
+
+    summary = profile_dataframe(df, chunk_rows=10_000).describe()["site"]
+
+    assert summary["freq"] == expected.iloc[0]
+    assert summary["top"] in expected[expected == expected.iloc[0]].index
+    assert "freq_error" not in summary
+
+
+def test_top_value_count_past_the_limit_is_a_bounded_lower_bound():
+    values = np.array(["hot"] * 5_000 + [f"u{i}" for i in range(50_000)], dtype=object)
+    np.random.default_rng(1).shuffle(values)
+
+    summary = profile_dataframe(pd.DataFrame({"v": values}), chunk_rows=10_000).describe()["v"]
+
+    assert summary["top"] == "hot"
+    assert summary["freq"] <= 5_000 <= summary["freq"] + summary["freq_error"]
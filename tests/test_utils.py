@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from utils import JsonObjectScanner, extract_json, find_json, read_csv_chunked
+
+
+def test_category_column_with_numbers_after_the_sample(tmp_path):
+    # The sample (first chunk) holds text, the second chunk only numbers.
+    lines = ["code,value"]
+    lines += [f"{'abc'[i % 3]},{i}" for i in range(20)]
+    lines += [f"{i % 4},{i}" for i in range(20, 40)]
+    path = tmp_path / "mixed.csv"
+    path.write_text("\n".join(lines) + "\n")
+
+    df, stats = read_csv_chunked(str(path), chunksize=20, sample_rows=20)
+
+    assert stats["rows"] == 40
+    assert isinstance(df["code"].dtype, pd.CategoricalDtype)
+    assert df["code"].tolist() == [line.split(",")[0] for line in lines[1:]]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('Here is the chart: {"mark": "bar"} Enjoy!', '{"mark": "bar"}'),
+        ('{"title": "a } and a \\" {", "mark": "line"}', '{"title": "a } and a \\" {", "mark": "line"}'),
+        ('[1, 2, {"a": 1}]', '[1, 2, {"a": 1}]'),
+        ('Charts: [{"mark": "bar"}, {"mark": "line"}] done', '[{"mark": "bar"}, {"mark": "line"}]'),
+        ('["]", {"a": "["}]', '["]", {"a": "["}]'),
+        ('{"data": [1, 2', None),
+        ('{"data": {"values": [1]}, "mark": "ba', '{"values": [1]}'),
+        ("no JSON here", None),
+    ],
+)
+def test_extract_json(text, expected):
+    assert extract_json(text) == expected
+
+
+def test_find_json_top_level_array():
+    assert find_json('[1,2,{"a":1}]') == (0, 13)
+
+
+def test_scanner_across_chunks():
+    text = 'Sure: [{"a": "x\\"]"}, [3]] and more'
+    scanner = JsonObjectScanner()
+    closed = [scanner.feed(text[i : i + 3]) for i in range(0, len(text), 3)]
+    assert closed[-1]
+    assert scanner.json_text == '[{"a": "x\\"]"}, [3]]'
@@ -1,11 +1,33 @@
 # utils.py
+import glob
+import io
+import json
+import math
 import os
+import sys
 import tempfile
+import time
 import webbrowser
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+import numpy as np
 import pandas as pd
 import os
 import regex as re
+from metrics import JSON_PARSE_FAILURES, timed
+from profiler import profile_dataframe
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_CHUNKSIZE = 100_000
+DEFAULT_SAMPLE_ROWS = 10_000
+CATEGORY_MAX_RATIO = 0.5
+DEFAULT_SNIFF_ROWS = 2_000
+SNIFF_BLOCKS = 32
+SNIFF_MIN_BYTES = 64 * 2**20
 def get_openai_api_key():
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key and os.path.exists(".env"):
@@ -14,6 +36,8 @@ def get_openai_api_key():
                 if line.startswith("OPENAI_API_KEY="):
                     api_key = line.split("=", 1)[1].strip()
                     break
+    if not api_key and os.getenv("VIZ_LLM_BASE_URL"):
+        api_key = "local"  # local servers (llm_server.py) don't check the key
     if not api_key:
         print("OpenAI API Key not found in environment variables or .env file.")
         api_key = input("Please enter your OpenAI API Key: ").strip()
@@ -36,33 +60,604 @@ def display_chart(chart):
         print(f"Failed to display chart: {e}")
 
 
-def deep_merge_dicts(dict1, dict2):
+def _deep_merge(dict1, dict2):
     merged = deepcopy(dict1)
     for key, value in dict2.items():
         if key in merged and isinstance(merged[key], dict) and isinstance(value, dict):
-            merged[key] = deep_merge_dicts(merged[key], value)
+            merged[key] = _deep_merge(merged[key], value)
         else:
             merged[key] = deepcopy(value)
     return merged
 
 
-def read_csv(file_path):
+def deep_merge_dicts(dict1, dict2):
+    # Timed once per top-level merge rather than once per nesting level.
+    with timed("deep_merge_dicts"):
+        return _deep_merge(dict1, dict2)
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process in bytes, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _smallest_int_dtype(low, high):
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _float32_exact(values):
+    """Whether a float array survives a round trip through float32 unchanged."""
+    return np.array_equal(values.astype(np.float32), values, equal_nan=True)
+
+
+def infer_dtypes(sample, category_max_ratio=CATEGORY_MAX_RATIO):
+    """
+    Pick compact dtypes for each column of a sample DataFrame.
+
+    Integer columns without missing values get the smallest int type that
+    holds the sampled range, float columns become float32 only when every
+    sampled value is exactly representable (later chunks are checked again),
+    and strings with few distinct values (relative to the sample) become
+    category.
+    """
+    dtypes = {}
+    for column in sample.columns:
+        series = sample[column]
+        if pd.api.types.is_integer_dtype(series):
+            dtypes[column] = _smallest_int_dtype(series.min(), series.max())
+        elif pd.api.types.is_float_dtype(series):
+            if _float32_exact(series.to_numpy()):
+                dtypes[column] = np.dtype(np.float32)
+        elif pd.api.types.is_object_dtype(series):
+            non_null = series.dropna()
+            if len(non_null) and non_null.nunique() <= category_max_ratio * len(non_null):
+                dtypes[column] = "category"
+    return dtypes
+
+
+def _as_text(series):
+    """A column pandas parsed as numbers, as the strings the same cells hold in a text column."""
+    if series.dtype.kind == "f":
+        values = series.dropna().to_numpy()
+        if len(values) and np.all(values == np.floor(values)) and np.abs(values).max() < 2**53:
+            series = series.astype("Int64")  # "3", not "3.0", for whole numbers read as float
+    return series.astype(str).where(series.notna())
+
+
+def _coerce_chunk(chunk, dtypes):
+    """Cast a parsed chunk to the inferred dtypes, widening any that no longer fit."""
+    for column, dtype in list(dtypes.items()):
+        if column not in chunk.columns:
+            continue
+        series = chunk[column]
+        if dtype == "category":
+            if not pd.api.types.is_object_dtype(series):
+                # Only numbers in this chunk; keep the categories strings like the sample's.
+                series = _as_text(series)
+            chunk[column] = series.astype("category")
+            continue
+        if dtype.kind == "i":
+            if not pd.api.types.is_integer_dtype(series):
+                # Missing values or fractions showed up after the sample.
+                dtype = dtypes[column] = np.dtype(np.float32)
+            elif len(series):
+                low, high = series.min(), series.max()
+                info = np.iinfo(dtype)
+                if low < info.min or high > info.max:
+                    dtype = dtypes[column] = _smallest_int_dtype(low, high)
+        if dtype.kind in "if" and not pd.api.types.is_numeric_dtype(series):
+            # Text showed up in a numeric column; keep pandas' own guess.
+            del dtypes[column]
+            continue
+        if dtype == np.float32 and not _float32_exact(series.to_numpy(dtype=np.float64, na_value=np.nan)):
+            # float32 would round these values; keep float64 from here on.
+            del dtypes[column]
+            continue
+        chunk[column] = series.astype(dtype)
+    return chunk
+
+
+def _missing_column(like, length):
+    if isinstance(like.dtype, pd.CategoricalDtype):
+        codes = np.full(length, -1, dtype=np.int8)
+        return pd.Series(pd.Categorical.from_codes(codes, dtype=like.dtype))
+    if like.dtype.kind == "f":
+        dtype = like.dtype
+    elif like.dtype.kind in "iu" and like.dtype.itemsize <= 2:
+        dtype = np.float32  # exact for int8/int16 values
+    else:
+        dtype = np.float64
+    return pd.Series(np.full(length, np.nan, dtype=dtype))
+
+
+def _concat_frames(frames):
+    """
+    Concatenate frames column by column, reconciling their schemas.
+
+    Columns are unioned in first-seen order and padded with missing values
+    where a frame lacks them; categorical parts are merged with
+    union_categoricals instead of falling back to object (unless their
+    categories differ in dtype), and other dtype mismatches are left to
+    pandas' usual upcasting.
+    """
+    if len(frames) == 1:
+        return frames[0]
+    names = list(dict.fromkeys(name for frame in frames for name in frame.columns))
+    columns = {}
+    for name in names:
+        like = next(frame[name] for frame in frames if name in frame.columns)
+        parts = [
+            frame[name] if name in frame.columns else _missing_column(like, len(frame))
+            for frame in frames
+        ]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            try:
+                merged = pd.api.types.union_categoricals(parts, ignore_order=True)
+                columns[name] = pd.Series(merged, name=name)
+            except TypeError:
+                # Categories of different dtypes cannot be unioned; fall back to object.
+                columns[name] = pd.concat([part.astype(object) for part in parts], ignore_index=True)
+        else:
+            columns[name] = pd.concat(parts, ignore_index=True, copy=False)
+    return pd.DataFrame(columns, copy=False)
+
+
+def _ingest_stats(df, start):
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": len(df),
+        "seconds": elapsed,
+        "rows_per_sec": len(df) / elapsed if elapsed else float("inf"),
+        "memory_bytes": int(df.memory_usage(index=False, deep=True).sum()),
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def read_csv_chunked(
+    file_path,
+    chunksize=DEFAULT_CHUNKSIZE,
+    sample_rows=DEFAULT_SAMPLE_ROWS,
+    memory_budget=None,
+    **read_kwargs,
+):
+    """
+    Read a CSV in bounded chunks, casting each chunk to dtypes inferred from
+    the leading `sample_rows` rows. `file_path` may also be a binary stream,
+    in which case dtypes are inferred from the first chunk instead.
+
+    Raises MemoryError once the parsed frame exceeds `memory_budget` bytes.
+    Returns the DataFrame and a stats dict with rows, seconds, rows/sec,
+    in-memory bytes and peak RSS.
+    """
+    start = time.perf_counter()
+    dtypes = None
+    if isinstance(file_path, (str, os.PathLike)):
+        dtypes = infer_dtypes(pd.read_csv(file_path, nrows=sample_rows, **read_kwargs))
+
+    chunks = []
+    used_bytes = 0
+    for chunk in pd.read_csv(file_path, chunksize=chunksize, **read_kwargs):
+        if dtypes is None:
+            dtypes = infer_dtypes(chunk)
+        chunk = _coerce_chunk(chunk, dtypes)
+        used_bytes += int(chunk.memory_usage(index=False, deep=True).sum())
+        if memory_budget is not None and used_bytes > memory_budget:
+            raise MemoryError(
+                f"CSV exceeds memory budget of {memory_budget} bytes "
+                f"after {sum(len(c) for c in chunks) + len(chunk)} rows"
+            )
+        chunks.append(chunk)
+
+    df = _concat_frames(chunks)
+    return df, _ingest_stats(df, start)
+
+
+def format_ingest_stats(stats):
+    peak = stats.get("peak_rss_bytes")
+    peak_text = f"{peak / 2**20:.1f} MiB" if peak is not None else "n/a"
+    return (
+        f"Read {stats['rows']} rows in {stats['seconds']:.2f}s "
+        f"({stats['rows_per_sec']:,.0f} rows/sec), "
+        f"{stats['memory_bytes'] / 2**20:.1f} MiB in memory, peak RSS {peak_text}"
+    )
+
+
+def expand_csv_paths(source):
+    """
+    Resolve a file path, directory or glob pattern to a sorted list of CSV paths.
+    A plain file path (or URL) is returned unchanged.
+    """
+    source = os.fspath(source)
+    if "://" in source:
+        return [source]
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, "*.csv")) + glob.glob(
+            os.path.join(source, "*.csv.gz")
+        )
+    elif glob.has_magic(source):
+        paths = glob.glob(source)
+    else:
+        return [source]
+    if not paths:
+        raise FileNotFoundError(f"No CSV files match {source!r}")
+    return sorted(paths)
+
+
+def _read_one(file_path, chunksize, memory_budget):
+    if chunksize is None and memory_budget is None:
+        return pd.read_csv(file_path)
+    df, _ = read_csv_chunked(
+        file_path, chunksize=chunksize or DEFAULT_CHUNKSIZE, memory_budget=memory_budget
+    )
+    return df
+
+
+def read_csv_many(paths, chunksize=None, memory_budget=None, max_workers=None):
+    """
+    Parse several CSV files in a process pool and concatenate them into one
+    frame with a reconciled schema. `memory_budget` applies to the result.
+    """
+    if len(paths) == 1 or max_workers == 1:
+        frames = [_read_one(path, chunksize, memory_budget) for path in paths]
+    else:
+        max_workers = min(max_workers or os.cpu_count() or 1, len(paths))
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            frames = list(
+                pool.map(
+                    _read_one,
+                    paths,
+                    [chunksize] * len(paths),
+                    [memory_budget] * len(paths),
+                )
+            )
+    df = _concat_frames(frames)
+    if memory_budget is not None:
+        used_bytes = int(df.memory_usage(index=False, deep=True).sum())
+        if used_bytes > memory_budget:
+            raise MemoryError(
+                f"CSV files exceed memory budget of {memory_budget} bytes ({used_bytes} bytes)"
+            )
+    return df
+
+
+def _format_bytes(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def _is_iso_date_column(series):
+    """True if every non-null value of a string column is an ISO-8601 date/time."""
+    non_null = series.dropna()
+    if not len(non_null) or pd.api.types.infer_dtype(non_null.head(1000), skipna=True) != "string":
+        return False
+    return bool(non_null.str.match(r"\d{4}-\d{2}").all())
+
+
+def optimize_dataframe(
+    df,
+    category_max_ratio=CATEGORY_MAX_RATIO,
+    parse_dates=True,
+    lossy_floats=False,
+    report=False,
+):
+    """
+    Return a copy of `df` using less memory.
+
+    Integers (and whole-valued floats without gaps) are downcast to the
+    smallest int type, floats become float32 when that is exact (always, with
+    `lossy_floats`), ISO-8601 date strings are parsed to datetime64 once and
+    low-cardinality strings are dictionary-encoded as category. `report`
+    prints the bytes saved per column.
+    """
+    optimized = {}
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_bool_dtype(series):
+            pass
+        elif pd.api.types.is_integer_dtype(series) and len(series):
+            series = series.astype(_smallest_int_dtype(series.min(), series.max()))
+        elif pd.api.types.is_float_dtype(series) and len(series):
+            values = series.to_numpy()
+            if not series.isna().any() and np.array_equal(values, np.round(values)):
+                series = series.astype(_smallest_int_dtype(values.min(), values.max()))
+            elif series.dtype != np.float32 and (lossy_floats or _float32_exact(values)):
+                series = pd.Series(values.astype(np.float32), index=series.index, name=column)
+        elif pd.api.types.is_object_dtype(series):
+            if parse_dates and _is_iso_date_column(series):
+                parsed = pd.to_datetime(series, format="ISO8601", errors="coerce")
+                if parsed.isna().sum() == series.isna().sum():
+                    series = parsed
+            if pd.api.types.is_object_dtype(series):
+                non_null = series.dropna()
+                if len(non_null) and non_null.nunique() <= category_max_ratio * len(non_null):
+                    series = series.astype("category")
+        optimized[column] = series
+    result = pd.DataFrame(optimized, index=df.index)
+
+    if report:
+        before = df.memory_usage(index=False, deep=True)
+        after = result.memory_usage(index=False, deep=True)
+        width = max([len(str(c)) for c in df.columns] + [6])
+        print(f"{'Column':<{width}}  {'Before':>10}  {'After':>10}  {'Saved':>10}  Dtype")
+        for column in df.columns:
+            print(
+                f"{str(column):<{width}}  {_format_bytes(before[column]):>10}  "
+                f"{_format_bytes(after[column]):>10}  "
+                f"{_format_bytes(before[column] - after[column]):>10}  {result[column].dtype}"
+            )
+        total_before, total_after = before.sum(), after.sum()
+        ratio = total_before / total_after if total_after else float("inf")
+        print(
+            f"{'Total':<{width}}  {_format_bytes(total_before):>10}  "
+            f"{_format_bytes(total_after):>10}  "
+            f"{_format_bytes(total_before - total_after):>10}  ({ratio:.1f}x smaller)"
+        )
+    return result
+
+
+def dataframe_to_records(df):
+    """
+    df.to_dict(orient="records") that json.dumps can serialize: datetime
+    columns are rendered back to ISO-8601 strings.
+    """
+    datetime_columns = df.select_dtypes(include=["datetime", "datetimetz"]).columns
+    if len(datetime_columns):
+        df = df.copy()
+        for column in datetime_columns:
+            values = df[column]
+            has_time = bool((values.dropna() != values.dropna().dt.normalize()).any())
+            df[column] = values.dt.strftime("%Y-%m-%dT%H:%M:%S" if has_time else "%Y-%m-%d")
+    return df.to_dict(orient="records")
+
+
+def read_csv(
+    file_path,
+    chunksize=None,
+    memory_budget=None,
+    report=False,
+    max_workers=None,
+    optimize=False,
+):
+    """
+    Read a CSV file into a DataFrame.
+
+    `file_path` may also be a directory or glob pattern; matching files are
+    parsed in parallel (up to `max_workers` processes) and concatenated.
+    Passing `chunksize` or `memory_budget` switches to the chunked,
+    dtype-aware reader, and `optimize` runs optimize_dataframe on the
+    result; `report` prints rows/sec, peak RSS and bytes saved.
+    """
     try:
-        df = pd.read_csv(file_path)
-        return df
+        start = time.perf_counter()
+        paths = expand_csv_paths(file_path)
+        if len(paths) > 1:
+            df = read_csv_many(paths, chunksize, memory_budget, max_workers)
+            stats = _ingest_stats(df, start)
+        elif chunksize is None and memory_budget is None:
+            df = pd.read_csv(paths[0])
+            stats = _ingest_stats(df, start)
+        else:
+            df, stats = read_csv_chunked(
+                paths[0],
+                chunksize=chunksize or DEFAULT_CHUNKSIZE,
+                memory_budget=memory_budget,
+            )
     except Exception as e:
         raise ValueError(f"Error reading CSV file: {e}")
+    if report:
+        print(format_ingest_stats(stats))
+    if optimize:
+        df = optimize_dataframe(df, report=report)
+    return df
+
+def should_sniff(file_path, min_bytes=SNIFF_MIN_BYTES):
+    """True for a single, seekable local CSV large enough to be worth sniffing."""
+    file_path = os.fspath(file_path)
+    return (
+        os.path.isfile(file_path)
+        and not file_path.endswith(".gz")
+        and os.path.getsize(file_path) >= min_bytes
+    )
+
+
+def sniff_csv(file_path, sample_rows=DEFAULT_SNIFF_ROWS, blocks=SNIFF_BLOCKS):
+    """
+    Sample rows from across a CSV without parsing all of it.
+
+    Seeks to `blocks` evenly spaced byte offsets, drops the partial line at
+    each one and reads a run of whole lines from there. Returns the parsed
+    sample and an estimate of the file's total row count. Rows containing
+    quoted newlines may be skipped when a seek lands inside them.
+    """
+    size = os.path.getsize(file_path)
+    lines = []
+    with open(file_path, "rb") as f:
+        header = f.readline()
+        data_start = f.tell()
+        span = size - data_start
+        per_block = max(1, sample_rows // blocks)
+        for block in range(blocks):
+            offset = data_start + span * block // blocks
+            if offset < f.tell():
+                offset = f.tell()  # blocks overlap on small files
+            else:
+                f.seek(offset)
+                if offset > data_start:
+                    f.readline()
+            for _ in range(per_block):
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line)
+    if lines and not lines[-1].endswith(b"\n"):
+        lines[-1] += b"\n"
+    sampled_bytes = sum(len(line) for line in lines)
+    estimated_rows = round(span * len(lines) / sampled_bytes) if sampled_bytes else 0
+    sample = pd.read_csv(io.BytesIO(header + b"".join(lines)), on_bad_lines="skip")
+    return sample, estimated_rows
+
+
+def _estimate_distinct(counts, sample_size, population_size):
+    """
+    GEE estimate of the number of distinct values in the population from the
+    value counts of a uniform sample: sqrt(N/n) * f1 + (values seen twice or more).
+    """
+    if sample_size == 0:
+        return 0
+    seen_once = int((counts == 1).sum())
+    if seen_once == sample_size:
+        return int(max(population_size, sample_size))  # no repeats: looks like a key
+    estimate = math.sqrt(max(population_size, sample_size) / sample_size) * seen_once
+    estimate += len(counts) - seen_once
+    return int(min(round(estimate), max(population_size, len(counts))))
+
+
+def summarize_sample(sample, estimated_rows, examples=5):
+    """Per-column type, null fraction, distinct-count estimate and example values."""
+    dtypes = infer_dtypes(sample)
+    description = {}
+    for column in sample.columns:
+        series = sample[column]
+        non_null = series.dropna()
+        counts = non_null.value_counts()
+        null_fraction = 1 - len(non_null) / len(series) if len(series) else 0.0
+        info = {
+            "dtype": str(dtypes.get(column, series.dtype)),
+            "null_fraction": round(null_fraction, 4),
+            "distinct_estimate": _estimate_distinct(
+                counts, len(non_null), round(estimated_rows * (1 - null_fraction))
+            ),
+            "examples": counts.index[:examples].tolist(),
+        }
+        if pd.api.types.is_numeric_dtype(series) and len(non_null):
+            info.update(min=non_null.min().item(), max=non_null.max().item(), mean=non_null.mean())
+        description[column] = info
+    return description
+
 
 def infer_csv_structure(df):
-    description = df.describe(include="all").to_dict()
+    description = profile_dataframe(df).describe()
     columns = df.columns.tolist()
     return description, columns
 
+JSON_OPENER_PATTERN = re.compile(r"[{\[]")
+JSON_STRUCTURAL_PATTERN = re.compile(r'[{}\[\]"]')
+JSON_STRING_SPECIAL_PATTERN = re.compile(r'["\\]')
+JSON_CLOSERS = {"}": "{", "]": "["}
+
+
+class JsonObjectScanner:
+    """
+    Incremental bracket matcher for streamed replies.
+
+    feed() takes text as it arrives and returns True once the first
+    top-level JSON object or array has closed; strings and escapes are
+    tracked so brackets inside values do not count, and a closer that does
+    not match the innermost open bracket is ignored. The regexes only jump
+    to the next bracket or quote and to the end of each string, so the cost
+    is linear in the text fed. Prose before the value is skipped without
+    tracking quotes.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.start = None
+        self.end = None
+        self.open = []  # (bracket, position) of the objects and arrays still open
+        self.nested = None  # (start, end) of the leftmost closed value inside the first one
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk):
+        if self.end is not None:
+            return True
+        offset = self.length
+        self.parts.append(chunk)
+        self.length += len(chunk)
+        pos = 0
+        if self.escape and chunk:
+            self.escape = False
+            pos = 1  # the escaped character ended the previous chunk's backslash
+        while True:
+            if self.in_string:
+                match = JSON_STRING_SPECIAL_PATTERN.search(chunk, pos)
+                if match is None:
+                    return False
+                pos = match.end()
+                if match.group() == '"':
+                    self.in_string = False
+                elif pos == len(chunk):
+                    self.escape = True
+                    return False
+                else:
+                    pos += 1
+            elif self.start is None:
+                match = JSON_OPENER_PATTERN.search(chunk, pos)
+                if match is None:
+                    return False
+                pos = match.end()
+                self.start = offset + match.start()
+                self.open.append((match.group(), self.start))
+            else:
+                match = JSON_STRUCTURAL_PATTERN.search(chunk, pos)
+                if match is None:
+                    return False
+                char, pos = match.group(), match.end()
+                if char == '"':
+                    self.in_string = True
+                elif char in "{[":
+                    self.open.append((char, offset + match.start()))
+                elif self.open[-1][0] == JSON_CLOSERS[char]:
+                    _, opened = self.open.pop()
+                    if not self.open:
+                        self.end = offset + pos
+                        return True
+                    if self.nested is None or opened < self.nested[0]:
+                        self.nested = (opened, offset + pos)
+
+    @property
+    def text(self):
+        """Everything fed so far, cut just after the value when it has closed."""
+        text = "".join(self.parts)
+        return text if self.end is None else text[: self.end]
+
+    @property
+    def json_text(self):
+        return self.text[self.start : self.end] if self.end is not None else None
+
+
+def find_json(text):
+    """
+    (start, end) of the first complete top-level JSON object or array in
+    `text`, or None. If that value never closes (a truncated reply), the
+    leftmost complete value nested inside it is returned instead, as the
+    old recursive pattern would have.
+    """
+    scanner = JsonObjectScanner()
+    if scanner.feed(text):
+        return scanner.start, scanner.end
+    return scanner.nested
+
+
+@timed("extract_json")
 def extract_json(text):
-    json_pattern = re.compile(r"\{(?:[^{}]|(?0))*\}")
-    match = json_pattern.search(text)
-    if match:
-        return match.group()
+    """The first complete JSON object or array in `text`, or None (see find_json)."""
+    span = find_json(text)
+    if span:
+        return text[span[0] : span[1]]
+    JSON_PARSE_FAILURES.labels(reason="no_json_object").inc()
     return None
 
 def extract_chart_type(vega_lite_schema):
@@ -2,77 +2,58 @@ import pandas as pd
 import openai
 import json
 import os
-import regex as re
 import time
-from utils import get_openai_api_key
+from utils import get_openai_api_key, read_csv, infer_csv_structure
+from prompt_summary import memoized_context
+from prompt_layout import build_messages
+from llm_cache import print_cache_stats
+from speculative import is_vega_lite_spec, print_speculative_stats, speculative_chat_completion
+from structured_output import reply_json, structured_request, vega_lite_schema
+from openai_client import get_client
+from metrics import TIME_TO_CHART_SECONDS, timed, write_output
+from spec_cache import lookup_spec, print_spec_cache_stats, store_spec
+from intent_parser import local_spec
+from semantic_types import detect_field_types
 
 openai.api_key = get_openai_api_key()
+# Specs are only replayed to the script whose instructions produced them.
+SPEC_NAMESPACE = "vega-lite-dashboard"
 
-def read_csv(file_path):
-    try:
-        df = pd.read_csv(file_path)
-        return df
-    except Exception as e:
-        raise ValueError(f"Error reading CSV file: {e}")
-
-def infer_csv_structure(df):
-    description = df.describe(include="all").to_dict()
-    columns = df.columns.tolist()
-    return description, columns
-
-def extract_json(text):
-    json_pattern = re.compile(r"\{(?:[^{}]|(?0))*\}")
-    match = json_pattern.search(text)
-    if match:
-        return match.group()
-    return None
-
-
+@timed("send_message_to_openai")
 def send_message_to_openai(conversation, dataframe_info, column_info, data_sample, api_key):
-    system_prompts = [
-        {
-            "role": "system",
-            "content": (
-                "You are an assistant that generates Vega-Lite JSON specifications based on user requests and provided data."
-                " Do **not** include the 'data' field with 'values' in your specifications."
-                " Assume that the data will be provided externally by the application."
-                " Focus solely on defining the visualization marks, encodings, and other specifications."
-            ),
-        },
-        {
-            "role": "system",
-            "content": (
-                "Please respond **only** with the Vega-Lite JSON specification. Do **not** include any explanations, comments, or additional text."
-                " Ensure that the JSON is valid and properly formatted."
-            ),
-        },
-        {
-            "role": "system",
-            "content": f"Here is a summary of the CSV data:\n{json.dumps(dataframe_info, indent=2)}",
-        },
-        {"role": "system", "content": f"Columns: {', '.join(column_info)}"},
-        {
-            "role": "system",
-            "content": f"Here is a sample of the data:\n{json.dumps(data_sample, indent=2)}"
-        },
-        {
-            "role": "system",
-            "content": (
-                "Do **not** include the 'data' field in your Vega-Lite specification."
-                " The data will be injected separately by the application."
-            ),
-        },
+    instructions = [
+        (
+            "You are an assistant that generates Vega-Lite JSON specifications based on user requests and provided data."
+            " Do **not** include the 'data' field with 'values' in your specifications."
+            " Assume that the data will be provided externally by the application."
+            " Focus solely on defining the visualization marks, encodings, and other specifications."
+        ),
+        (
+            "Please respond **only** with the Vega-Lite JSON specification. Do **not** include any explanations, comments, or additional text."
+            " Ensure that the JSON is valid and properly formatted."
+        ),
+        (
+            "Do **not** include the 'data' field in your Vega-Lite specification."
+            " The data will be injected separately by the application."
+        ),
+    ]
+    context = [
+        *memoized_context(dataframe_info, column_info, data_sample),
     ]
-    messages = system_prompts + conversation
+    # Static instructions first, then this dataset, then the turns: see prompt_layout.
+    messages = build_messages(instructions, context, conversation)
 
     try:
-        response = openai.chat.completions.create(
+        assistant_reply = speculative_chat_completion(
+            get_client(),
+            validate=is_vega_lite_spec,
             model="gpt-4o",
             messages=messages,
             temperature=0.3,
             max_tokens=2000,
+            stream=True,
+            **structured_request("vega_lite_spec", vega_lite_schema(column_info)),
         )
-        assistant_reply = response.choices[0].message.content
         return assistant_reply
     except Exception as e:
         raise ConnectionError(f"Error communicating with OpenAI: {e}")
@@ -105,10 +86,12 @@ def initialize_html(html_file='output-vega-lite-dashboard.html'):
             </html>
         """)
 
+@timed("append_json_to_html")
 def append_json_to_html(json_data, data, html_file='output-vega-lite-dashboard.html'):
     initialize_html(html_file)
     visualization_id = f"vis_{int(time.time() * 1000)}"
-    json_data['data'] = {'values': data}
+    # A copy, so the spec the caller keeps in the conversation doesn't carry every data row.
+    json_data = dict(json_data, data={'values': data})
     visualization_html = f"""
     <div class="visualization">
         <div id="{visualization_id}"></div>
@@ -126,15 +109,14 @@ def append_json_to_html(json_data, data, html_file='output-vega-lite-dashboard.h
         insertion_point = len(content)
 
     new_content = content[:insertion_point] + visualization_html + content[insertion_point:]
-    with open(html_file, 'w') as f:
-        f.write(new_content)
+    write_output(html_file, new_content)
 def main():
     try:
         api_key = get_openai_api_key()
     except ValueError as ve:
         print(ve)
         return
-    csv_path = input("Enter the path to your CSV file: ").strip()
+    csv_path = input("Enter the path to your CSV file (or a directory or glob of CSV files): ").strip()
     try:
         df = read_csv(csv_path)
         print("\nCSV file successfully uploaded and read!")
@@ -154,22 +136,29 @@ def main():
     # Convert the DataFrame to a list of records (JSON)
     data_as_json = df.to_dict(orient='records')
     data_sample = df.head(5).to_dict(orient='records')
+    field_types = detect_field_types(df)
 
     while True:
         user_input = input("You: ").strip()
+        turn_start = time.perf_counter()
         if user_input.lower() in ["exit", "quit"]:
             print("Ending the chat. Goodbye!")
+            print_cache_stats()
+            print_spec_cache_stats()
+            print_speculative_stats()
             break
         if user_input:
             conversation.append({"role": "user", "content": user_input})
+        local = local_spec(user_input, field_types)
+        cached_spec = json.dumps(local) if local else lookup_spec(SPEC_NAMESPACE, columns, user_input, conversation[:-1])
         try:
-            assistant_reply = send_message_to_openai(
+            assistant_reply = cached_spec or send_message_to_openai(
                 conversation, description, columns, data_sample, api_key
             )
         except ConnectionError as ce:
             print(ce)
             continue
-        extracted_json = extract_json(assistant_reply)
+        extracted_json = reply_json(assistant_reply)
         if extracted_json:
             try:
                 vega_lite_json = json.loads(extracted_json)
@@ -178,6 +167,8 @@ def main():
                 
                 # Append the JSON to the HTML file with embedded data
                 append_json_to_html(vega_lite_json, data_as_json)
+                TIME_TO_CHART_SECONDS.labels(entry_point="vega-lite-dashboard").observe(time.perf_counter() - turn_start)
+                store_spec(SPEC_NAMESPACE, columns, user_input, extracted_json, conversation[:-1])
 
                 conversation.append(
                     {"role": "assistant", "content": json.dumps(vega_lite_json)}
@@ -2,59 +2,43 @@ import pandas as pd
 import openai
 import json
 import os
-import regex as re
-from utils import get_openai_api_key
+from utils import get_openai_api_key, read_csv, infer_csv_structure
+from prompt_summary import memoized_context
+from prompt_layout import build_messages
+from llm_cache import print_cache_stats
+from speculative import is_vega_lite_spec, print_speculative_stats, speculative_chat_completion
+from structured_output import reply_json, structured_request, vega_lite_schema
+from openai_client import get_client
+from metrics import timed
+from spec_cache import lookup_spec, print_spec_cache_stats, store_spec
 
 openai.api_key = get_openai_api_key()
+# Specs are only replayed to the script whose instructions produced them.
+SPEC_NAMESPACE = "vega-lite"
 
 
-def read_csv(file_path):
-    try:
-        df = pd.read_csv(file_path)
-        return df
-    except Exception as e:
-        raise ValueError(f"Error reading CSV file: {e}")
-
-
-def infer_csv_structure(df):
-    description = df.describe(include="all").to_dict()
-    columns = df.columns.tolist()
-    return description, columns
-
-
-def extract_json(text):
-    json_pattern = re.compile(r"\{(?:[^{}]|(?0))*\}")
-    match = json_pattern.search(text)
-    if match:
-        return match.group()
-    return None
-
-
+@timed("send_message_to_openai")
 def send_message_to_openai(conversation, dataframe_info, column_info, api_key):
-    system_prompts = [
-        {
-            "role": "system",
-            "content": (
-                "You are an assistant that generates Vega-Lite JSON schemas based on user requests and provided data."
-            ),
-        },
-        {
-            "role": "system",
-            "content": f"Here is a summary of the CSV data:\n{json.dumps(dataframe_info, indent=2)}",
-        },
-        {"role": "system", "content": f"Columns: {', '.join(column_info)}"},
+    instructions = [
+        "You are an assistant that generates Vega-Lite JSON schemas based on user requests and provided data.",
     ]
-
-    messages = system_prompts + conversation
+    context = [
+        *memoized_context(dataframe_info, column_info),
+    ]
+    # Static instructions first, then this dataset, then the turns: see prompt_layout.
+    messages = build_messages(instructions, context, conversation)
 
     try:
-        response = openai.chat.completions.create(
+        assistant_reply = speculative_chat_completion(
+            get_client(),
+            validate=is_vega_lite_spec,
             model="gpt-4o",
             messages=messages,
             temperature=0.3,
             max_tokens=2000,
+            stream=True,
+            **structured_request("vega_lite_spec", vega_lite_schema(column_info)),
         )
-        assistant_reply = response.choices[0].message.content
         return assistant_reply
     except Exception as e:
         raise ConnectionError(f"Error communicating with OpenAI: {e}")
@@ -66,7 +50,7 @@ def main():
     except ValueError as ve:
         print(ve)
         return
-    csv_path = input("Enter the path to your CSV file: ").strip()
+    csv_path = input("Enter the path to your CSV file (or a directory or glob of CSV files): ").strip()
     try:
         df = read_csv(csv_path)
         print("\nCSV file successfully uploaded and read!")
@@ -86,21 +70,26 @@ def main():
         user_input = input("You: ").strip()
         if user_input.lower() in ["exit", "quit"]:
             print("Ending the chat. Goodbye!")
+            print_cache_stats()
+            print_spec_cache_stats()
+            print_speculative_stats()
             break
         if user_input:
             conversation.append({"role": "user", "content": user_input})
+        cached_spec = lookup_spec(SPEC_NAMESPACE, columns, user_input, conversation[:-1])
         try:
-            assistant_reply = send_message_to_openai(
+            assistant_reply = cached_spec or send_message_to_openai(
                 conversation, description, columns, api_key
             )
         except ConnectionError as ce:
             print(ce)
             continue
-        extracted_json = extract_json(assistant_reply)
+        extracted_json = reply_json(assistant_reply)
         if extracted_json:
             try:
                 vega_lite_json = json.loads(extracted_json)
                 print(json.dumps(vega_lite_json, indent=2))
+                store_spec(SPEC_NAMESPACE, columns, user_input, extracted_json, conversation[:-1])
                 conversation.append(
                     {"role": "assistant", "content": json.dumps(vega_lite_json)}
                 )
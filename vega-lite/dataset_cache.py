@@ -0,0 +1,365 @@
+# dataset_cache.py
+"""
+On-disk cache of parsed CSV files.
+
+Each entry is a directory named after the file's content hash holding one
+memory-mappable .npy file per column plus a meta.json describing how to
+rebuild the DataFrame. index.json maps (path, size, mtime) to the content
+hash so a repeat session skips both hashing and parsing.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from utils import expand_csv_paths, infer_csv_structure, read_csv
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "visualization")
+DEFAULT_MAX_BYTES = 2 * 2**30
+HASH_BLOCK_SIZE = 2**20
+PROFILE_VERSION = 2  # 2: top-value counts carry freq_error when they are lower bounds
+
+# index.json is read, updated and rewritten; threads of one process take turns.
+_index_lock = threading.Lock()
+
+
+def get_cache_dir(name):
+    base = os.getenv("VIZ_CACHE_DIR", DEFAULT_CACHE_DIR)
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def hash_file(file_path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json_atomic(path, payload):
+    # A unique temporary name, so concurrent writers never share one.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+JSON_CATEGORY_TYPES = ("string", "integer", "floating", "boolean")
+
+
+def _save_column(entry_dir, position, series):
+    """
+    Write one column to disk, returning its meta.json description, or None
+    for a column the cache cannot round-trip (tz-aware and other extension
+    dtypes, categories that are not plain JSON values, mixed objects).
+    """
+    path = os.path.join(entry_dir, f"{position}.npy")
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        if pd.api.types.infer_dtype(dtype.categories, skipna=True) not in JSON_CATEGORY_TYPES:
+            return None
+        np.save(path, series.cat.codes.to_numpy())
+        return {"kind": "category", "categories": series.cat.categories.tolist()}
+    if not isinstance(dtype, np.dtype):
+        return None  # np.save would pickle these, and load() refuses pickles
+    if pd.api.types.is_datetime64_dtype(dtype):
+        np.save(path, series.to_numpy().view("int64"))
+        return {"kind": "datetime", "dtype": str(dtype)}
+    if dtype == object:
+        codes, uniques = pd.factorize(series)
+        if not all(isinstance(value, str) for value in uniques):
+            return None
+        np.save(path, codes)
+        return {"kind": "object", "categories": list(uniques)}
+    np.save(path, series.to_numpy())
+    return {"kind": "numpy"}
+
+
+def _load_column(entry_dir, position, meta):
+    values = np.load(os.path.join(entry_dir, f"{position}.npy"), mmap_mode="r")
+    if meta["kind"] == "category":
+        return pd.Categorical.from_codes(values, categories=meta["categories"])
+    if meta["kind"] == "datetime":
+        return np.asarray(values).view(meta["dtype"])
+    if meta["kind"] == "object":
+        uniques = np.array(meta["categories"] + [np.nan], dtype=object)
+        # Code -1 marks missing values and picks the trailing NaN.
+        return uniques.take(values)
+    return values
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+class DatasetCache:
+    """Content-addressed columnar cache of parsed DataFrames with LRU eviction."""
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or get_cache_dir("datasets")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if max_bytes is None:
+            max_bytes = int(os.getenv("VIZ_DATASET_CACHE_BYTES", DEFAULT_MAX_BYTES))
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def fingerprint(self, file_path, options=None, hash_missing=True):
+        """
+        Return the cache key for `file_path` (a file, directory or glob),
+        hashing file contents only when their path/size/mtime is unseen.
+        With hash_missing=False an unseen file returns None instead of
+        being hashed.
+        """
+        with _index_lock:
+            index = self._load_index()
+        new_hashes = {}  # path -> (stat key, content hash)
+        content_hashes = []
+        for path in expand_csv_paths(file_path):
+            path = os.path.abspath(path)
+            stat_key = _stat_key(path)
+            content_hash = index.get(stat_key)
+            if content_hash is None:
+                if not hash_missing:
+                    return None
+                content_hash = hash_file(path)  # outside the lock: it can take a while
+                new_hashes[path] = (stat_key, content_hash)
+            content_hashes.append(content_hash)
+        if new_hashes:
+            with _index_lock:
+                # Re-read so entries other threads added meanwhile are kept.
+                index = self._load_index()
+                for path, (stat_key, content_hash) in new_hashes.items():
+                    # Forget earlier versions of the same file.
+                    index = {k: v for k, v in index.items() if not k.startswith(f"{path}|")}
+                    index[stat_key] = content_hash
+                _write_json_atomic(self.index_path, index)
+        if len(content_hashes) == 1:
+            key = content_hashes[0]
+        else:
+            key = hashlib.blake2b("".join(content_hashes).encode(), digest_size=20).hexdigest()
+        if options:
+            options_digest = hashlib.blake2b(
+                json.dumps(options, sort_keys=True, default=str).encode(), digest_size=8
+            ).hexdigest()
+            return f"{key}-{options_digest}"
+        return key
+
+    def load(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            columns = {
+                name: _load_column(entry_dir, position, column_meta)
+                for position, (name, column_meta) in enumerate(
+                    zip(meta["columns"], meta["column_meta"])
+                )
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(meta_path)  # mark as recently used for LRU eviction
+        return pd.DataFrame(columns, columns=meta["columns"])
+
+    def store(self, key, df):
+        """Write `df` under `key`. Frames with a column _save_column cannot write are skipped."""
+        if not df.columns.is_unique:
+            return False
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=f"{key}.", suffix=".tmp")
+        try:
+            column_meta = []
+            for position, name in enumerate(df.columns):
+                meta = _save_column(tmp_dir, position, df[name])
+                if meta is None:
+                    return False
+                column_meta.append(meta)
+            _write_json_atomic(
+                os.path.join(tmp_dir, "meta.json"),
+                {"columns": [str(c) for c in df.columns], "column_meta": column_meta},
+            )
+            entry_dir = os.path.join(self.cache_dir, key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # Another thread stored the same key in between; its copy is just as good.
+                if not os.path.isdir(entry_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+        return True
+
+    def entries(self):
+        """Yield (last_used, size_bytes, path) for every cache entry."""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue  # still being written
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry_dir, "meta.json")
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir)
+                )
+                last_used = os.path.getmtime(meta_path)
+            except OSError:
+                continue  # not an entry, or removed by another thread meanwhile
+            yield last_used, size, entry_dir
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+_default_cache = None
+
+
+def get_dataset_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DatasetCache()
+    return _default_cache
+
+
+def _cache_options(read_kwargs):
+    # The worker count does not change the parsed result.
+    return {k: v for k, v in read_kwargs.items() if k != "max_workers"}
+
+
+def read_csv_cached(file_path, cache=None, report=False, **read_kwargs):
+    """
+    Drop-in replacement for utils.read_csv that serves repeat loads of the
+    same file (or set of files) from the dataset cache.
+    """
+    cache = cache or get_dataset_cache()
+    start = time.perf_counter()
+    try:
+        key = cache.fingerprint(file_path, _cache_options(read_kwargs))
+    except OSError as e:
+        raise ValueError(f"Error reading CSV file: {e}")
+    df = cache.load(key)
+    if df is not None:
+        if report:
+            elapsed = time.perf_counter() - start
+            print(f"Loaded {len(df)} rows from dataset cache in {elapsed * 1000:.1f} ms")
+        return df
+    df = read_csv(file_path, report=report, **read_kwargs)
+    try:
+        cache.store(key, df)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Warning: could not cache dataset: {e}")
+    return df
+
+
+def cache_parsed_csv(file_path, df, cache=None, **read_kwargs):
+    """Seed the cache with a frame parsed elsewhere from `file_path` with `read_kwargs`."""
+    cache = cache or get_dataset_cache()
+    try:
+        cache.store(cache.fingerprint(file_path, read_kwargs), df)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Warning: could not cache dataset: {e}")
+
+
+_profile_memo = {}
+
+
+def _profile_path(key):
+    return os.path.join(get_cache_dir("profiles"), f"{key}-v{PROFILE_VERSION}.json")
+
+
+def _stored_profile(key):
+    profile = _profile_memo.get(key)
+    if profile is None:
+        try:
+            with open(_profile_path(key), "r") as f:
+                stored = json.load(f)
+            profile = _profile_memo[key] = (stored["description"], stored["columns"])
+        except (OSError, ValueError, KeyError):
+            return None
+    return profile
+
+
+def cached_profile(file_path, cache=None, **read_kwargs):
+    """
+    Return the (description, columns) profile of `file_path` if this session
+    or an earlier one already computed it, else None. Only the path/size/mtime
+    index is consulted, never the file's contents, so this is cheap enough to
+    call on the main thread while the file loads in the background.
+    """
+    cache = cache or get_dataset_cache()
+    try:
+        key = cache.fingerprint(file_path, _cache_options(read_kwargs), hash_missing=False)
+    except OSError:
+        return None
+    return _stored_profile(key) if key else None
+
+
+def dataset_profile(file_path, df=None, cache=None, **read_kwargs):
+    """
+    Profile `file_path` once per dataset fingerprint: the result is kept in
+    memory for the session and on disk across sessions. `df` avoids a
+    reload when the caller already has the parsed frame.
+    """
+    cache = cache or get_dataset_cache()
+    key = cache.fingerprint(file_path, _cache_options(read_kwargs))
+    profile = _stored_profile(key)
+    if profile is not None:
+        return profile
+    if df is None:
+        df = read_csv_cached(file_path, cache=cache, **read_kwargs)
+    profile = infer_csv_structure(df)
+    _profile_memo[key] = profile
+    try:
+        _write_json_atomic(
+            _profile_path(key), {"description": profile[0], "columns": profile[1]}
+        )
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Warning: could not cache dataset profile: {e}")
+    return profile
+
+
+def _load_and_profile(file_path, **read_kwargs):
+    df = read_csv_cached(file_path, **read_kwargs)
+    dataset_profile(file_path, df, **read_kwargs)
+    return df
+
+
+_background_pool = None
+
+
+def read_csv_in_background(file_path, **read_kwargs):
+    """
+    Load (and profile) `file_path` on a worker thread and return a Future
+    for the DataFrame.
+    """
+    global _background_pool
+    if _background_pool is None:
+        _background_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="csv-load")
+    return _background_pool.submit(_load_and_profile, file_path, **read_kwargs)
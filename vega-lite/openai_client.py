@@ -0,0 +1,126 @@
+# openai_client.py
+"""
+Shared OpenAI clients with a tuned connection pool and an explicit retry policy.
+
+One sync and one async client (per event loop) are created per process, so
+TCP connections and TLS sessions are reused across requests. The SDK's own
+retries are turned off; create_with_retries() retries transient failures
+(connection errors, timeouts, 408/409/429 and 5xx) with full-jitter
+exponential backoff, waiting out the server's Retry-After when it sends one.
+VIZ_LLM_BASE_URL points both clients at another OpenAI-compatible server,
+such as the local mock/record/replay server in llm_server.py.
+"""
+import asyncio
+import os
+import random
+import time
+
+import httpx
+import openai
+
+from utils import get_openai_api_key
+
+MAX_RETRIES = int(os.getenv("VIZ_OPENAI_MAX_RETRIES", 4))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+MAX_RETRY_AFTER = 120.0
+POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=120)
+REQUEST_TIMEOUT = httpx.Timeout(float(os.getenv("VIZ_OPENAI_TIMEOUT", 120)), connect=5.0)
+RETRYABLE_STATUS = {408, 409, 429}
+
+_client = None
+_async_clients = {}
+
+
+def _api_key():
+    return openai.api_key or get_openai_api_key()
+
+
+def _base_url():
+    # An OpenAI-compatible endpoint to use instead of the API, e.g. llm_server.py.
+    return os.getenv("VIZ_LLM_BASE_URL") or None
+
+
+def get_client():
+    """The process-wide openai.OpenAI client."""
+    global _client
+    if _client is None:
+        _client = openai.OpenAI(
+            api_key=_api_key(),
+            base_url=_base_url(),
+            max_retries=0,
+            timeout=REQUEST_TIMEOUT,
+            http_client=openai.DefaultHttpxClient(limits=POOL_LIMITS, timeout=REQUEST_TIMEOUT),
+        )
+    return _client
+
+
+def get_async_client():
+    """The openai.AsyncOpenAI client for the running event loop (its pool is bound to the loop)."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = openai.AsyncOpenAI(
+            api_key=_api_key(),
+            base_url=_base_url(),
+            max_retries=0,
+            timeout=REQUEST_TIMEOUT,
+            http_client=openai.DefaultAsyncHttpxClient(limits=POOL_LIMITS, timeout=REQUEST_TIMEOUT),
+        )
+    return client
+
+
+def is_transient(error):
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        should_retry = error.response.headers.get("x-should-retry")
+        if should_retry in ("true", "false"):
+            return should_retry == "true"
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        return None  # HTTP-date form; fall back to backoff
+    return None
+
+
+def retry_delay(attempt, error=None):
+    """Seconds to wait before retry number `attempt` (0-based)."""
+    retry_after = _retry_after(error) if error is not None else None
+    if retry_after is not None and 0 <= retry_after <= MAX_RETRY_AFTER:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def create_with_retries(client, max_retries=MAX_RETRIES, **request):
+    """client.chat.completions.create(**request), retrying transient failures."""
+    for attempt in range(max_retries + 1):
+        try:
+            return client.chat.completions.create(**request)
+        except Exception as e:
+            if attempt == max_retries or not is_transient(e):
+                raise
+            time.sleep(retry_delay(attempt, e))
+
+
+async def async_create_with_retries(client, max_retries=MAX_RETRIES, **request):
+    """create_with_retries for an openai.AsyncOpenAI client."""
+    for attempt in range(max_retries + 1):
+        try:
+            return await client.chat.completions.create(**request)
+        except Exception as e:
+            if attempt == max_retries or not is_transient(e):
+                raise
+            await asyncio.sleep(retry_delay(attempt, e))
@@ -0,0 +1,352 @@
+# profiler.py
+"""
+Single-pass, mergeable column profiling.
+
+Each column is summarized with sketches that can be updated one chunk at a
+time and merged across chunks (or processes): streaming moments for
+mean/std, a centroid sketch for approximate quantiles, HyperLogLog for
+distinct counts and a counter for the most frequent values that stays exact
+up to TOP_K_EXACT_LIMIT distinct values. The summary has the same keys as
+DataFrame.describe(include="all"), restricted to the ones that apply to each
+column, plus "freq_error" when the top value's count is only a lower bound.
+"""
+import numpy as np
+import pandas as pd
+
+QUANTILE_CENTROIDS = 256
+HLL_PRECISION = 12
+TOP_K_CAPACITY = 64
+TOP_K_EXACT_LIMIT = 10_000
+PROFILE_CHUNKSIZE = 100_000
+
+
+class MomentSketch:
+    """Count, min, max, mean and variance, merged with Chan's parallel update."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        if not len(values):
+            return
+        other = MomentSketch()
+        other.count = len(values)
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        self.merge(other)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * self.count * other.count / total
+        self.mean += delta * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else np.nan
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles from at most `size` weighted centroids.
+
+    Updates and merges pool the centroids, sort them and re-bucket into
+    equal-weight groups, so every step is a handful of vectorized NumPy calls.
+    """
+
+    def __init__(self, size=QUANTILE_CENTROIDS):
+        self.size = size
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def update(self, values):
+        if not len(values):
+            return
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        if len(values) <= self.size:
+            self._absorb(values, np.ones(len(values)))
+            return
+        # Collapse the sorted chunk into `size` equal-count centroids before merging.
+        starts = np.linspace(0, len(values), self.size, endpoint=False).astype(np.int64)
+        weights = np.diff(np.append(starts, len(values))).astype(np.float64)
+        self._absorb(np.add.reduceat(values, starts) / weights, weights)
+
+    def merge(self, other):
+        if len(other.means):
+            self._absorb(other.means, other.weights)
+
+    def _absorb(self, means, weights):
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        if len(means) > self.size:
+            cumulative = np.cumsum(weights)
+            buckets = np.minimum(
+                (cumulative - weights / 2) * self.size // cumulative[-1], self.size - 1
+            ).astype(np.int64)
+            bucket_weights = np.bincount(buckets, weights=weights, minlength=self.size)
+            bucket_sums = np.bincount(buckets, weights=means * weights, minlength=self.size)
+            keep = bucket_weights > 0
+            means = bucket_sums[keep] / bucket_weights[keep]
+            weights = bucket_weights[keep]
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        if not len(self.means):
+            return np.nan
+        cumulative = np.cumsum(self.weights)
+        midpoints = (cumulative - self.weights / 2) / cumulative[-1]
+        return float(np.interp(q, midpoints, self.means))
+
+
+class HyperLogLog:
+    """Distinct-count sketch over 64-bit pandas hashes (about 1.6% error at p=12)."""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, values):
+        """Add a Series or NumPy array of (non-null) values."""
+        if not len(values):
+            return
+        if isinstance(values, pd.Series):
+            hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(np.uint64)
+        else:
+            hashes = pd.util.hash_array(values)
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        rest = hashes << np.uint64(p)
+        # Bit length of `rest`, exact because each 32-bit half converts to float64 losslessly.
+        high = (rest >> np.uint64(32)).astype(np.float64)
+        low = (rest & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        bit_length = np.where(high > 0, np.frexp(high)[1] + 32, np.frexp(low)[1])
+        rank = np.minimum(64 - bit_length + 1, 64 - p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))  # linear counting for small sets
+        return int(round(raw))
+
+
+class TopK:
+    """
+    Frequent-value counter. Counts are exact while at most `exact_limit`
+    distinct values have been seen; past that the table is cut to
+    `capacity` values Misra-Gries style, and `error` bounds how far below
+    its true count each kept count may be.
+    """
+
+    def __init__(self, capacity=TOP_K_CAPACITY, exact_limit=TOP_K_EXACT_LIMIT):
+        self.capacity = capacity
+        self.exact_limit = exact_limit
+        self.counts = pd.Series(dtype=np.int64)
+        self.error = 0
+
+    @property
+    def exact(self):
+        return self.error == 0
+
+    def update(self, series):
+        if len(series):
+            self.update_counts(series.value_counts(sort=False))
+
+    def update_counts(self, counts):
+        """Absorb exact value counts (a Series indexed by value) for one chunk."""
+        if len(counts) > self.exact_limit:
+            # Cut a high-cardinality chunk before merging instead of adding every value.
+            values = counts.to_numpy()
+            top = np.argpartition(values, -(self.capacity + 1))[-(self.capacity + 1):]
+            counts = counts.iloc[top].sort_values(ascending=False, kind="stable")
+            self.error += int(counts.iloc[self.capacity])
+            counts = counts.iloc[: self.capacity] - counts.iloc[self.capacity]
+        self._absorb(counts)
+
+    def merge(self, other):
+        self.error += other.error
+        self._absorb(other.counts)
+
+    def _absorb(self, counts):
+        counts = counts[counts > 0]
+        if not len(counts):
+            return
+        merged = counts if not len(self.counts) else self.counts.add(counts, fill_value=0)
+        if len(merged) > (self.exact_limit if self.exact else self.capacity):
+            merged = merged.sort_values(ascending=False, kind="stable")
+            cut = int(merged.iloc[self.capacity])
+            merged = merged.iloc[: self.capacity] - cut
+            merged = merged[merged > 0]
+            self.error += cut
+        self.counts = merged.astype(np.int64)
+
+    def most_common(self, n=1):
+        return list(self.counts.nlargest(n, keep="first").items())
+
+
+class ColumnProfile:
+    """Mergeable sketches for one column; numeric and datetime columns also get moments and quantiles."""
+
+    def __init__(self, kind):
+        self.kind = kind  # "numeric", "datetime" or "categorical"
+        self.rows = 0
+        self.non_null = 0
+        self.distinct = HyperLogLog()
+        self.top = TopK()
+        if kind != "categorical":
+            self.moments = MomentSketch()
+            self.quantiles = QuantileSketch()
+
+    @staticmethod
+    def kind_of(series):
+        if pd.api.types.is_bool_dtype(series):
+            return "categorical"
+        if pd.api.types.is_numeric_dtype(series):
+            return "numeric"
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return "datetime"
+        return "categorical"
+
+    def update(self, series):
+        self.rows += len(series)
+        if self.kind == "categorical":
+            # One factorize pass; the sketches then only touch the distinct values.
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+            else:
+                codes, uniques = pd.factorize(series)
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            seen = counts > 0
+            values = np.asarray(uniques, dtype=object)[seen]
+            self.non_null += int(counts.sum())
+            self.distinct.update(pd.Series(values))
+            self.top.update_counts(pd.Series(counts[seen], index=values))
+            return
+        if self.kind == "datetime":
+            values = series.to_numpy().view("int64")[series.notna().to_numpy()]
+        else:
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            values = values[~np.isnan(values)]
+        self.non_null += len(values)
+        self.distinct.update(values)
+        values = values.astype(np.float64, copy=False)
+        self.moments.update(values)
+        self.quantiles.update(values)
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.non_null += other.non_null
+        self.distinct.merge(other.distinct)
+        if self.kind == "categorical":
+            self.top.merge(other.top)
+        else:
+            self.moments.merge(other.moments)
+            self.quantiles.merge(other.quantiles)
+
+    def summary(self):
+        """describe()-style statistics for this column."""
+        if self.kind == "categorical":
+            count = self.non_null
+            summary = {"count": count, "unique": min(self.distinct.estimate(), count)}
+            top = self.top.most_common(1)
+            if top:
+                value, freq = top[0]
+                summary.update(top=value.item() if hasattr(value, "item") else value, freq=int(freq))
+                if not self.top.exact:
+                    summary["freq_error"] = self.top.error  # freq is a lower bound, off by at most this
+            return summary
+        moments = self.moments
+        summary = {
+            "count": moments.count,
+            "mean": moments.mean if moments.count else np.nan,
+            "std": moments.std,
+            "min": moments.min if moments.count else np.nan,
+            "25%": self.quantiles.quantile(0.25),
+            "50%": self.quantiles.quantile(0.5),
+            "75%": self.quantiles.quantile(0.75),
+            "max": moments.max if moments.count else np.nan,
+        }
+        if self.kind == "datetime":
+            for key in ("mean", "min", "25%", "50%", "75%", "max"):
+                if not np.isnan(summary[key]):
+                    summary[key] = pd.Timestamp(int(summary[key])).isoformat()
+            summary.pop("std")
+        return summary
+
+    def as_categorical(self):
+        """
+        Fall back to a categorical profile when later chunks turn out not to
+        be numeric; row, null and distinct counts carry over.
+        """
+        profile = ColumnProfile("categorical")
+        profile.rows, profile.non_null, profile.distinct = self.rows, self.non_null, self.distinct
+        return profile
+
+
+class DatasetProfile:
+    """Per-column profiles for a table, built chunk by chunk and mergeable."""
+
+    def __init__(self):
+        self.columns = {}
+
+    def update(self, chunk):
+        for name in chunk.columns:
+            series = chunk[name]
+            kind = ColumnProfile.kind_of(series)
+            profile = self.columns.get(name)
+            if profile is None:
+                profile = self.columns[name] = ColumnProfile(kind)
+            elif profile.kind != kind and series.notna().any():
+                profile = self.columns[name] = profile.as_categorical()
+            profile.update(series)
+        return self
+
+    def merge(self, other):
+        for name, profile in other.columns.items():
+            mine = self.columns.get(name)
+            if mine is None:
+                self.columns[name] = profile
+                continue
+            if mine.kind != profile.kind:
+                mine = self.columns[name] = mine.as_categorical()
+                profile = profile.as_categorical()
+            mine.merge(profile)
+        return self
+
+    def describe(self):
+        return {name: profile.summary() for name, profile in self.columns.items()}
+
+
+def profile_dataframe(df, chunk_rows=PROFILE_CHUNKSIZE):
+    """Profile an in-memory frame, `chunk_rows` rows at a time."""
+    profile = DatasetProfile()
+    for start in range(0, max(len(df), 1), chunk_rows):
+        profile.update(df.iloc[start : start + chunk_rows])
+    return profile
+
+
+def profile_csv(file_path, chunksize=PROFILE_CHUNKSIZE, **read_kwargs):
+    """Profile a CSV chunk by chunk without ever holding the whole file."""
+    profile = DatasetProfile()
+    for chunk in pd.read_csv(file_path, chunksize=chunksize, **read_kwargs):
+        profile.update(chunk)
+    return profile
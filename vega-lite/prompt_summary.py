@@ -0,0 +1,211 @@
+# prompt_summary.py
+"""
+Token-budgeted dataset summaries for prompts.
+
+The profile dicts built by utils.infer_csv_structure / summarize_sample are
+rendered as one dense line per column (type, range, cardinality, top
+values). Statistics a chart request does not need (std, quartiles, counts)
+are dropped, and when the text exceeds the token budget columns fall back to
+shorter lines, starting from the last column, until it fits.
+
+dataset_context() renders the whole dataset block of a prompt (summary,
+column list and data sample) within one budget: the column list and the
+sample, serialized compactly with long values cut, get a fixed share and
+the summary the rest.
+"""
+import json
+import os
+
+import regex as re
+
+try:
+    import tiktoken
+except ImportError:  # approximate counts without it
+    tiktoken = None
+
+DEFAULT_SUMMARY_TOKENS = int(os.getenv("VIZ_SUMMARY_TOKENS", 400))
+DEFAULT_CONTEXT_TOKENS = int(os.getenv("VIZ_CONTEXT_TOKENS", 800))
+COLUMNS_SHARE = 8  # the column list gets at most 1/8 of the context budget
+SAMPLE_SHARE = 4  # and the data sample at most 1/4
+SUMMARY_MODEL = "gpt-4o"
+APPROX_TOKEN_PATTERN = re.compile(r"\p{L}+|\p{N}{1,3}|[^\s\p{L}\p{N}]")
+SUMMARY_HEADER = "One line per column: name: type, range or distinct count, top values."
+
+_encoding = None
+
+
+def count_tokens(text, model=SUMMARY_MODEL):
+    """Token count of `text` for `model`; approximated when tiktoken is missing."""
+    global _encoding
+    if tiktoken is None:
+        return len(APPROX_TOKEN_PATTERN.findall(text))
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encoding = tiktoken.get_encoding("o200k_base")
+    return len(_encoding.encode(text))
+
+
+def _number(value):
+    return f"{value:.6g}" if isinstance(value, float) else str(value)
+
+
+def _short(value, width=24):
+    text = str(value).removesuffix(" 00:00:00")
+    return text if len(text) <= width else text[: width - 1] + "…"
+
+
+def _field_type(stats, field_types, name):
+    if field_types and name in field_types:
+        return field_types[name]["type"]
+    if "datetime" in str(stats.get("dtype", "")) or isinstance(stats.get("mean"), str):
+        return "temporal"
+    if "mean" in stats or "min" in stats:
+        return "quantitative"
+    return "nominal"
+
+
+def _column_lines(name, stats, field_type):
+    """The same column at decreasing levels of detail, longest first."""
+    parts = [field_type]
+    if "min" in stats and "max" in stats:
+        low, high = stats["min"], stats["max"]
+        if isinstance(low, str):
+            low, high = low[:10], high[:10]  # dates: drop the time of day
+        parts.append(f"{_number(low)}..{_number(high)}")
+    distinct = stats.get("unique", stats.get("distinct_estimate"))
+    if distinct is not None and field_type != "quantitative":
+        parts.append(f"{distinct} distinct")
+    if stats.get("null_fraction"):
+        parts.append(f"{stats['null_fraction']:.0%} null")
+
+    detail = []
+    if "top" in stats:
+        # A sketched count is a lower bound and shown as one; a top value within its error is left out.
+        error = stats.get("freq_error", 0)
+        if error < stats.get("freq", 1):
+            freq = f"≥{stats['freq']}" if error else stats.get("freq", "?")
+            detail.append(f"top {_short(stats['top'])!r} ({freq}/{stats.get('count', '?')})")
+    elif stats.get("examples") and field_type != "quantitative":
+        detail.append("e.g. " + ", ".join(repr(_short(v)) for v in stats["examples"][:3]))
+    if field_type == "quantitative" and "50%" in stats:
+        detail.append(f"median {_number(stats['50%'])}")
+
+    return [
+        f"{name}: " + ", ".join(parts + detail),
+        f"{name}: " + ", ".join(parts),
+        f"{name}: {field_type}",
+    ]
+
+
+def compact_summary(description, field_types=None, budget=DEFAULT_SUMMARY_TOKENS):
+    """
+    Render `description` ({column: stats}) in at most `budget` tokens.
+
+    Returns (text, tokens) with the measured token count of the text. If
+    even the shortest line per column is over budget, trailing columns are
+    replaced by a count of the omitted ones.
+    """
+    options = [
+        _column_lines(name, stats, _field_type(stats, field_types, name))
+        for name, stats in description.items()
+    ]
+    costs = [[count_tokens(line) + 1 for line in lines] for lines in options]
+    levels = [0] * len(options)
+    total = count_tokens(SUMMARY_HEADER) + sum(cost[0] for cost in costs)
+
+    # Shorten the last columns first; the leading ones are usually the most used.
+    for level in (1, 2):
+        for i in reversed(range(len(options))):
+            if total <= budget:
+                break
+            total -= costs[i][levels[i]] - costs[i][level]
+            levels[i] = level
+
+    lines = [options[i][levels[i]] for i in range(len(options))]
+    if total > budget:
+        total += count_tokens(f"... and {len(options)} more columns") + 1
+        while total > budget and lines:
+            total -= costs[len(lines) - 1][2]
+            lines.pop()
+    omitted = len(options) - len(lines)
+    if omitted:
+        lines.append(f"... and {omitted} more columns")
+    text = "\n".join([SUMMARY_HEADER] + lines)
+    return text, count_tokens(text)
+
+
+def compact_columns(columns, budget):
+    """
+    "Columns: a, b, ..." in at most `budget` tokens; trailing names that do
+    not fit are replaced by a count of the omitted ones.
+    """
+    names = [str(column) for column in columns]
+    total = count_tokens("Columns: ")
+    kept = 0
+    for name in names:
+        cost = count_tokens(name) + 1
+        if total + cost > budget:
+            break
+        total += cost
+        kept += 1
+    text = "Columns: " + ", ".join(names[:kept])
+    if kept < len(names):
+        text += f"\n... and {len(names) - kept} more columns"
+    return text
+
+
+def _short_record(record):
+    return {key: _short(value) if isinstance(value, str) else value for key, value in record.items()}
+
+
+def compact_sample(records, budget):
+    """
+    Sample rows as compact JSON in at most `budget` tokens, long strings cut
+    and trailing rows dropped until it fits. None if not even one row fits.
+    """
+    rows = [_short_record(record) for record in records]
+    while rows:
+        text = json.dumps(rows, separators=(",", ":"), ensure_ascii=False, default=str)
+        if count_tokens(text) <= budget:
+            return text
+        rows.pop()
+    return None
+
+
+def dataset_context(description, columns, sample=None, field_types=None, budget=DEFAULT_CONTEXT_TOKENS):
+    """
+    The dataset blocks of a prompt: summary, column list and (when given)
+    the data sample, together in at most about `budget` tokens.
+
+    Returns (blocks, tokens) with the measured token count of the blocks as
+    build_messages() joins them.
+    """
+    column_text = compact_columns(columns, budget // COLUMNS_SHARE)
+    used = count_tokens(column_text)
+    sample_text = None
+    if sample is not None:
+        sample_text = compact_sample(sample, budget // SAMPLE_SHARE)
+        if sample_text is not None:
+            used += count_tokens(sample_text)
+    summary, _ = compact_summary(description, field_types, budget - used)
+    blocks = [f"Here is a compact summary of the CSV data:\n{summary}", column_text]
+    if sample_text is not None:
+        blocks.append(f"Here is a sample of the data:\n{sample_text}")
+    return tuple(blocks), count_tokens("\n\n".join(blocks))
+
+
+_context_memo = {}
+
+
+def memoized_context(description, columns, sample=None, field_types=None, budget=DEFAULT_CONTEXT_TOKENS):
+    """dataset_context(...)[0], computed once per set of inputs."""
+    inputs = (description, columns, sample, field_types)
+    key = tuple(map(id, inputs)) + (budget,)
+    cached = _context_memo.get(key)
+    # Keeping the inputs alive in the entry stops their ids from being reused.
+    if cached is None or any(a is not b for a, b in zip(cached[0], inputs)):
+        blocks, _ = dataset_context(description, columns, sample, field_types, budget)
+        cached = _context_memo[key] = (inputs, blocks)
+    return cached[1]
@@ -0,0 +1,307 @@
+# spec_cache.py
+"""
+Near-duplicate cache of generated chart specs.
+
+The response cache in llm_cache.py only answers byte-identical requests.
+This one answers requests that mean the same thing for the same dataset:
+"bar chart of visits by site" and "show visits per site as bars" both
+normalize to the chart word "bar" plus the columns they mention, in order.
+
+Prompts are normalized by lowercasing, light stemming, resolving column
+mentions against the dataset's columns, mapping synonyms to one word and
+dropping stopwords. Entries are bucketed by namespace, dataset schema,
+conversation context and the ordered column mentions. Each entry point uses
+its own namespace: their instructions differ (chart types allowed, data
+sample or not), so a spec made for one script may be wrong for another. Within a bucket an inverted index
+finds candidates, which are scored by Jaccard similarity of their remaining
+words. A match at or above VIZ_SPEC_CACHE_THRESHOLD (default 0.75) returns
+the stored spec. VIZ_SPEC_CACHE=0 disables the cache.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from dataset_cache import get_cache_dir
+from metrics import SPEC_CACHE_LOOKUPS
+
+DEFAULT_THRESHOLD = 0.75
+DEFAULT_MAX_ENTRIES = 5_000
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset(
+    """
+    a an the of for to in on at by per with and or as from into over across each every
+    me my i we us our you your it its this that these those please can could would will
+    show shows display draw plot plots make create give generate visualize visualise want need
+    chart charts graph graphs diagram figure visualization visualisation view using use
+    is are be should all some data dataset value values
+    """.split()
+)
+
+SYNONYMS = {
+    "bar": "bar", "column": "bar", "histogram": "bar", "barchart": "bar",
+    "line": "line", "trend": "line", "timeline": "line", "linechart": "line", "time": "line",
+    "pie": "arc", "donut": "arc", "doughnut": "arc", "arc": "arc", "share": "arc", "proportion": "arc",
+    "scatter": "point", "point": "point", "dot": "point", "scatterplot": "point",
+    "area": "area",
+    "heatmap": "rect", "heat": "rect", "rect": "rect",
+    "count": "count", "number": "count", "frequency": "count",
+    "average": "mean", "avg": "mean", "mean": "mean",
+    "total": "sum", "sum": "sum",
+    "maximum": "max", "max": "max", "highest": "max", "largest": "max",
+    "minimum": "min", "min": "min", "lowest": "min", "smallest": "min",
+    "colour": "color", "colored": "color", "coloured": "color",
+}
+
+
+def _stem(word):
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def prompt_words(text):
+    """Lowercased, lightly stemmed words of `text`."""
+    return [_stem(word) for word in WORD_PATTERN.findall(text.lower())]
+
+
+class _ColumnMatcher:
+    """Finds mentions of a dataset's columns in a list of normalized words."""
+
+    def __init__(self, columns):
+        self.phrases = {}  # tuple of words -> column
+        by_word = {}
+        for column in columns:
+            words = tuple(prompt_words(str(column)))
+            if words:
+                self.phrases.setdefault(words, column)
+            for word in set(words) - STOPWORDS:
+                by_word.setdefault(word, set()).add(column)
+        # A single word names a column only when no other column shares it and it
+        # isn't a chart or aggregate word ("number" alone doesn't mean "Number of Visits").
+        self.words = {
+            word: next(iter(owners))
+            for word, owners in by_word.items()
+            if len(owners) == 1 and word not in SYNONYMS
+        }
+        self.longest = max((len(phrase) for phrase in self.phrases), default=0)
+
+    def match(self, words, i):
+        """(column, words consumed) for a mention starting at words[i], or (None, 0)."""
+        for length in range(min(self.longest, len(words) - i), 0, -1):
+            column = self.phrases.get(tuple(words[i : i + length]))
+            if column is not None:
+                return column, length
+        column = self.words.get(words[i])
+        return (column, 1) if column is not None else (None, 0)
+
+
+_matchers = {}
+
+
+def column_matcher(columns):
+    """The (memoized) _ColumnMatcher for a list of column names."""
+    key = tuple(map(str, columns))
+    matcher = _matchers.get(key)
+    if matcher is None:
+        matcher = _matchers[key] = _ColumnMatcher(key)
+    return matcher
+
+
+def normalize_prompt(prompt, columns):
+    """(ordered column mentions, set of remaining normalized words) for `prompt`."""
+    words = prompt_words(prompt)
+    matcher = column_matcher(columns)
+    mentioned, terms = [], set()
+    i = 0
+    while i < len(words):
+        column, consumed = matcher.match(words, i)
+        if column is not None:
+            if column not in mentioned:
+                mentioned.append(column)
+            i += consumed
+            continue
+        word = SYNONYMS.get(words[i], words[i])
+        if word not in STOPWORDS:
+            terms.add(word)
+        i += 1
+    return tuple(mentioned), frozenset(terms)
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def bucket_key(namespace, columns, mentioned, context=None):
+    """Hash of what must match exactly: backend, schema, conversation so far, columns mentioned."""
+    canonical = json.dumps(
+        [namespace, list(map(str, columns)), context or [], list(mentioned)],
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class _Bucket:
+    """Entries sharing a bucket key, with an inverted index over their words."""
+
+    def __init__(self):
+        self.entries = {}  # terms (frozenset) -> spec
+        self.postings = {}  # word -> set of terms
+
+    def add(self, terms, spec):
+        self.entries[terms] = spec
+        for word in terms:
+            self.postings.setdefault(word, set()).add(terms)
+
+    def best(self, terms):
+        """(similarity, stored terms, spec) of the closest entry, or None."""
+        spec = self.entries.get(terms)
+        if spec is not None:
+            return 1.0, terms, spec
+        candidates = set().union(*(self.postings.get(word, ()) for word in terms)) if terms else set()
+        if frozenset() in self.entries:
+            candidates.add(frozenset())
+        best = None
+        for candidate in candidates:
+            similarity = jaccard(terms, candidate)
+            if best is None or similarity > best[0]:
+                best = (similarity, candidate, self.entries[candidate])
+        return best
+
+
+class SpecCache:
+    """SQLite-backed near-duplicate spec cache with an in-memory similarity index."""
+
+    def __init__(self, path=None, threshold=None, max_entries=None):
+        self.path = path or os.path.join(get_cache_dir("llm"), "specs.sqlite")
+        if threshold is None:
+            threshold = float(os.getenv("VIZ_SPEC_CACHE_THRESHOLD", DEFAULT_THRESHOLD))
+        if max_entries is None:
+            max_entries = int(os.getenv("VIZ_SPEC_CACHE_ENTRIES", DEFAULT_MAX_ENTRIES))
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS specs ("
+            " bucket TEXT NOT NULL, terms TEXT NOT NULL, spec TEXT NOT NULL, prompt TEXT NOT NULL,"
+            " last_used REAL NOT NULL, PRIMARY KEY (bucket, terms))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS specs_last_used ON specs (last_used)")
+
+    def _bucket(self, key):
+        # Buckets are loaded from SQLite the first time this process looks one up.
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket()
+            for terms, spec in self._db.execute("SELECT terms, spec FROM specs WHERE bucket = ?", (key,)):
+                bucket.add(frozenset(json.loads(terms)), spec)
+        return bucket
+
+    def get(self, namespace, columns, prompt, context=None):
+        """The stored spec for a request close enough to `prompt`, or None."""
+        mentioned, terms = normalize_prompt(prompt, columns)
+        key = bucket_key(namespace, columns, mentioned, context)
+        with self._lock:
+            best = self._bucket(key).best(terms)
+            if best is None or best[0] < self.threshold:
+                self.misses += 1
+                SPEC_CACHE_LOOKUPS.labels(result="miss").inc()
+                return None
+            similarity, stored_terms, spec = best
+            if similarity == 1.0:
+                self.exact_hits += 1
+            else:
+                self.similar_hits += 1
+            SPEC_CACHE_LOOKUPS.labels(result="exact" if similarity == 1.0 else "similar").inc()
+            self._db.execute(
+                "UPDATE specs SET last_used = ? WHERE bucket = ? AND terms = ?",
+                (time.time(), key, json.dumps(sorted(stored_terms))),
+            )
+            return spec
+
+    def put(self, namespace, columns, prompt, spec, context=None):
+        mentioned, terms = normalize_prompt(prompt, columns)
+        key = bucket_key(namespace, columns, mentioned, context)
+        with self._lock:
+            self._bucket(key).add(terms, spec)
+            self._db.execute(
+                "INSERT OR REPLACE INTO specs (bucket, terms, spec, prompt, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(sorted(terms)), spec, prompt, time.time()),
+            )
+            self._db.execute(
+                "DELETE FROM specs WHERE rowid IN ("
+                " SELECT rowid FROM specs ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM specs")
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM specs").fetchone()[0]
+        hits = self.exact_hits + self.similar_hits
+        lookups = hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+_default_cache = None
+
+
+def get_spec_cache():
+    """The shared spec cache, or None when VIZ_SPEC_CACHE=0 disables it."""
+    global _default_cache
+    if os.getenv("VIZ_SPEC_CACHE", "1") == "0":
+        return None
+    if _default_cache is None:
+        _default_cache = SpecCache()
+    return _default_cache
+
+
+def lookup_spec(namespace, columns, prompt, context=None):
+    """get() on the shared cache; None when it is disabled or `prompt` is empty."""
+    cache = get_spec_cache()
+    if cache is None or not prompt:
+        return None
+    return cache.get(namespace, columns, prompt, context)
+
+
+def store_spec(namespace, columns, prompt, spec, context=None):
+    cache = get_spec_cache()
+    if cache is not None and prompt:
+        cache.put(namespace, columns, prompt, spec, context)
+
+
+def print_spec_cache_stats():
+    cache = get_spec_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(
+            f"Spec cache: {stats['exact_hits']} exact and {stats['similar_hits']} near-duplicate hits, "
+            f"{stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries stored"
+        )
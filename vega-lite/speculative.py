@@ -0,0 +1,133 @@
+# speculative.py
+"""
+Speculative multi-candidate generation, opt-in with VIZ_LLM_CANDIDATES=<n>.
+
+An invalid reply normally costs the user a whole extra turn. With n >= 2 a
+response-cache miss is sent as one streamed request for n candidates (the
+API's `n` parameter), so the prompt is sent and billed once. Each candidate
+is scanned as its chunks arrive; the first whose JSON object closes and
+passes `validate` is returned and the stream is closed, which stops the
+others. When no candidate is valid the first to finish is returned, and the
+caller's usual error path runs. Only valid winners are cached.
+
+Per process it counts requests won by the first candidate to finish,
+requests saved (an earlier candidate finished invalid, so a single request
+would have cost another turn), requests with no valid candidate, and the
+completion tokens spent on candidates that were not used.
+"""
+import json
+import os
+import threading
+
+from llm_cache import cached_chat_completion, get_response_cache, is_json_object, request_key
+from metrics import (
+    LLM_CACHE_LOOKUPS,
+    SPECULATIVE_EXTRA_TOKENS,
+    SPECULATIVE_REQUESTS,
+    record_usage,
+    timed,
+)
+from openai_client import create_with_retries
+from prompt_summary import count_tokens
+from utils import JsonObjectScanner
+
+OUTCOMES = ("first_valid", "saved", "all_invalid")
+VEGA_LITE_VIEW_KEYS = ("mark", "layer", "concat", "hconcat", "vconcat", "facet", "repeat")
+
+_stats = dict.fromkeys(OUTCOMES + ("extra_tokens",), 0)
+_stats_lock = threading.Lock()
+
+
+def candidate_count():
+    """Candidates per request from VIZ_LLM_CANDIDATES; 1 (the default) turns speculation off."""
+    return max(1, int(os.getenv("VIZ_LLM_CANDIDATES", 1)))
+
+
+def is_vega_lite_spec(text):
+    """A JSON object with a mark or a view composition."""
+    try:
+        spec = json.loads(text)
+    except ValueError:
+        return False
+    return isinstance(spec, dict) and any(key in spec for key in VEGA_LITE_VIEW_KEYS)
+
+
+def _race(client, request, candidates, validate):
+    """(reply, valid) from the first candidate that closes a valid JSON object."""
+    scanners = {}
+    finished = []  # candidate indices in the order they completed
+    winner = None
+    with timed("llm_request"):
+        response = create_with_retries(client, stream=True, n=candidates, **request)
+        try:
+            for chunk in response:
+                for choice in chunk.choices:
+                    scanner = scanners.setdefault(choice.index, JsonObjectScanner())
+                    done = choice.finish_reason is not None
+                    if choice.delta is not None and choice.delta.content:
+                        done = scanner.feed(choice.delta.content) or done
+                    if not done or choice.index in finished:
+                        continue
+                    finished.append(choice.index)
+                    json_text = scanner.json_text
+                    if json_text is not None and validate(json_text):
+                        winner = choice.index
+                        break
+                if winner is not None:
+                    break  # closing the stream stops the other candidates
+        finally:
+            response.close()
+
+    if winner is not None:
+        used, result = winner, "first_valid" if finished[0] == winner else "saved"
+    else:
+        used, result = (finished[0] if finished else min(scanners, default=None)), "all_invalid"
+    tokens = {index: count_tokens(scanner.text) for index, scanner in scanners.items()}
+    extra = sum(count for index, count in tokens.items() if index != used)
+    prompt_tokens = sum(count_tokens(m.get("content") or "") for m in request.get("messages", []))
+    record_usage(request.get("model", "unknown"), prompt_tokens, sum(tokens.values()))
+    SPECULATIVE_REQUESTS.labels(result=result).inc()
+    SPECULATIVE_EXTRA_TOKENS.inc(extra)
+    with _stats_lock:
+        _stats[result] += 1
+        _stats["extra_tokens"] += extra
+    return (scanners[used].text if used is not None else None), winner is not None
+
+
+def speculative_chat_completion(client, cache=None, validate=is_json_object, **request):
+    """
+    cached_chat_completion that, when VIZ_LLM_CANDIDATES is 2 or more, races
+    that many candidates on a cache miss and returns the first one whose JSON
+    object passes `validate` (a function of the object's text).
+    """
+    candidates = candidate_count()
+    if candidates < 2:
+        return cached_chat_completion(client, cache, **request)
+    request.pop("stream", None)  # candidates are always streamed
+    cache = cache or get_response_cache()
+    key = request_key(request)
+    reply = cache.get(key) if cache is not None else None
+    if cache is not None:
+        LLM_CACHE_LOOKUPS.labels(result="miss" if reply is None else "hit").inc()
+    if reply is None:
+        reply, valid = _race(client, request, candidates, validate)
+        if valid and cache is not None:
+            cache.put(key, reply)
+    return reply
+
+
+def speculative_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["requests"] = sum(stats[outcome] for outcome in OUTCOMES)
+    return stats
+
+
+def print_speculative_stats():
+    stats = speculative_stats()
+    if stats["requests"]:
+        print(
+            f"Speculative generation: {stats['requests']} requests, {stats['first_valid']} won by the first "
+            f"candidate, {stats['saved']} saved a round-trip, {stats['all_invalid']} with no valid candidate; "
+            f"{stats['extra_tokens']} extra completion tokens"
+        )
@@ -0,0 +1,176 @@
+# structured_output.py
+"""
+Schema-constrained replies, opt-in with VIZ_STRUCTURED_OUTPUT=1.
+
+Instead of scraping a JSON object out of free text, requests carry the
+API's response_format: a strict JSON schema for main.py's recommendation
+and customizations and for a Vega-Lite subset (marks, x/y/color/theta and
+tooltip encodings over the dataset's own columns), and plain JSON mode for
+Chart.js configs. The reply is then the JSON document itself: it is parsed
+once, with no regex scan, and a reply that still fails to parse (a refusal
+or a reply cut off at max_tokens) is counted in viz_json_parse_failures
+with reason "structured_invalid".
+
+Strict schemas require every property, so optional values come back as
+null and are dropped by parse_structured(). Schemas that list a dataset's
+columns differ per dataset; the API compiles each new schema once, so the
+first request on a dataset can take longer.
+"""
+import functools
+import json
+import os
+
+from metrics import JSON_PARSE_FAILURES
+from utils import extract_json
+
+MARKS = ["bar", "line", "area", "point", "circle", "tick", "rect", "arc", "boxplot"]
+FIELD_TYPES = ["quantitative", "temporal", "ordinal", "nominal"]
+AGGREGATES = ["count", "sum", "mean", "median", "min", "max", "distinct"]
+TIME_UNITS = ["year", "quarter", "month", "yearmonth", "yearmonthdate", "date", "day", "hours"]
+CHANNELS = ("x", "y", "color", "theta")
+
+
+def structured_output_enabled():
+    return os.getenv("VIZ_STRUCTURED_OUTPUT", "0") == "1"
+
+
+def _object(properties):
+    # Strict mode: every property is required and nothing else is allowed.
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _nullable(schema):
+    schema = dict(schema)
+    schema["type"] = [schema["type"], "null"]
+    if "enum" in schema:
+        schema["enum"] = schema["enum"] + [None]
+    return schema
+
+
+def _column(columns):
+    return {"type": "string", "enum": list(columns)}
+
+
+CUSTOMIZATION_SCHEMA = _object(
+    {
+        "color": _nullable({"type": "string"}),
+        "interactive": _nullable({"type": "boolean"}),
+        "x_axis_label": _nullable({"type": "string"}),
+        "y_axis_label": _nullable({"type": "string"}),
+        "title": _nullable({"type": "string"}),
+    }
+)
+
+
+def recommendation_schema(columns):
+    """Schema for main.py's chart recommendation over `columns`."""
+    return _recommendation_schema(tuple(map(str, columns)))
+
+
+def vega_lite_schema(columns):
+    """Schema for the single-view Vega-Lite subset the scripts generate over `columns`."""
+    return _vega_lite_schema(tuple(map(str, columns)))
+
+
+# Built once per column list, so every request on a dataset sends the same bytes.
+@functools.lru_cache(maxsize=64)
+def _recommendation_schema(columns):
+    transformation = _object(
+        {
+            "operation": {"type": "string", "enum": ["group_by", "sum", "mean", "count", "sort", "filter"]},
+            "column": _column(columns),
+        }
+    )
+    return _object(
+        {
+            "chart_type": {"type": "string", "enum": ["bar", "line", "pie"]},
+            "x_column": _column(columns),
+            "y_column": _column(columns),
+            "transformations": {"type": "array", "items": transformation},
+            "rationale": {"type": "string"},
+        }
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _vega_lite_schema(columns):
+    field_def = _object(
+        {
+            "field": _column(columns),
+            "type": {"type": "string", "enum": FIELD_TYPES},
+            "aggregate": _nullable({"type": "string", "enum": AGGREGATES}),
+            "timeUnit": _nullable({"type": "string", "enum": TIME_UNITS}),
+            "title": _nullable({"type": "string"}),
+        }
+    )
+    encoding = {channel: {"anyOf": [field_def, {"type": "null"}]} for channel in CHANNELS}
+    encoding["tooltip"] = {"type": "array", "items": field_def}
+    return _object(
+        {
+            "title": _nullable({"type": "string"}),
+            "width": _nullable({"type": "integer"}),
+            "height": _nullable({"type": "integer"}),
+            "mark": _object(
+                {
+                    "type": {"type": "string", "enum": MARKS},
+                    "tooltip": {"type": "boolean"},
+                    "point": _nullable({"type": "boolean"}),
+                }
+            ),
+            "encoding": _object(encoding),
+        }
+    )
+
+
+def structured_request(name, schema):
+    """Extra request arguments constraining the reply to `schema`; empty when the mode is off."""
+    if not structured_output_enabled():
+        return {}
+    return {"response_format": {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}}
+
+
+def json_mode_request():
+    """Extra request arguments for a reply that is one JSON object; empty when the mode is off."""
+    if not structured_output_enabled():
+        return {}
+    return {"response_format": {"type": "json_object"}}
+
+
+def drop_nulls(value):
+    """`value` without the null members strict schemas make the model fill in."""
+    if isinstance(value, dict):
+        return {key: drop_nulls(item) for key, item in value.items() if item is not None}
+    if isinstance(value, list):
+        return [drop_nulls(item) for item in value]
+    return value
+
+
+def parse_structured(reply):
+    """The object of a structured reply, nulls dropped. Raises ValueError if it isn't one."""
+    try:
+        parsed = json.loads(reply or "")
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        JSON_PARSE_FAILURES.labels(reason="structured_invalid").inc()
+        raise ValueError("structured reply is not a JSON object")
+    return drop_nulls(parsed)
+
+
+def reply_json(reply):
+    """
+    The JSON object text of a reply: in structured mode the reply itself,
+    re-serialized without nulls (None if it doesn't parse), otherwise
+    whatever extract_json() finds in the free text.
+    """
+    if not structured_output_enabled():
+        return extract_json(reply)
+    try:
+        return json.dumps(parse_structured(reply))
+    except ValueError:
+        return None
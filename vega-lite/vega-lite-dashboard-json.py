@@ -2,19 +2,32 @@ import pandas as pd
 import openai
 import json
 import os
-import regex as re
 import time
 import copy
 from utils import (
     get_openai_api_key,
     deep_merge_dicts,
-    read_csv,
-    infer_csv_structure,
-    extract_json,
-    extract_chart_type
+    extract_chart_type,
+    dataframe_to_records,
+    should_sniff,
+    sniff_csv,
+    summarize_sample,
 )
+from dataset_cache import cached_profile, dataset_profile, read_csv_in_background
+from prompt_summary import memoized_context
+from prompt_layout import build_messages
+from llm_cache import print_cache_stats
+from speculative import is_vega_lite_spec, print_speculative_stats, speculative_chat_completion
+from structured_output import reply_json, structured_request, vega_lite_schema
+from openai_client import get_client
+from metrics import TIME_TO_CHART_SECONDS, timed, write_output
+from spec_cache import lookup_spec, print_spec_cache_stats, store_spec
+from intent_parser import local_spec
+from semantic_types import apply_field_types, describe_field_types, detect_field_types
 from templates import line_chart_template, bar_chart_template, pie_chart_template
 openai.api_key = get_openai_api_key()
+# Specs are only replayed to the script whose instructions produced them.
+SPEC_NAMESPACE = "vega-lite/vega-lite-dashboard-json"
 
 
 def select_template(chart_type):
@@ -27,51 +40,43 @@ def select_template(chart_type):
 
 
 
-def send_message_to_openai(conversation, dataframe_info, column_info, data_sample):
-    system_prompts = [
-        {
-            "role": "system",
-            "content": (
-                "You are an assistant that generates Vega-Lite JSON specifications based on user requests and provided data."
-                " Do **not** include the 'data' field with 'values' in your specifications."
-                " Assume that the data will be provided externally by the application."
-                " Focus solely on defining the visualization marks, encodings, and other specifications."
-            ),
-        },
-        {
-            "role": "system",
-            "content": (
-                "Please respond **only** with the Vega-Lite JSON specification. Do **not** include any explanations, comments, or additional text."
-                " Ensure that the JSON is valid and properly formatted."
-            ),
-        },
-        {
-            "role": "system",
-            "content": f"Here is a summary of the CSV data:\n{json.dumps(dataframe_info, indent=2)}",
-        },
-        {"role": "system", "content": f"Columns: {', '.join(column_info)}"},
-        {
-            "role": "system",
-            "content": f"Here is a sample of the data:\n{json.dumps(data_sample, indent=2)}",
-        },
-        {
-            "role": "system",
-            "content": (
-                "Do **not** include the 'data' field in your Vega-Lite specification."
-                " The data will be injected separately by the application."
-            ),
-        },
+@timed("send_message_to_openai")
+def send_message_to_openai(conversation, dataframe_info, column_info, data_sample, field_types=None):
+    instructions = [
+        (
+            "You are an assistant that generates Vega-Lite JSON specifications based on user requests and provided data."
+            " Do **not** include the 'data' field with 'values' in your specifications."
+            " Assume that the data will be provided externally by the application."
+            " Focus solely on defining the visualization marks, encodings, and other specifications."
+        ),
+        (
+            "Please respond **only** with the Vega-Lite JSON specification. Do **not** include any explanations, comments, or additional text."
+            " Ensure that the JSON is valid and properly formatted."
+        ),
+        (
+            "Do **not** include the 'data' field in your Vega-Lite specification."
+            " The data will be injected separately by the application."
+        ),
     ]
-    messages = system_prompts + conversation
+    context = [
+        *memoized_context(dataframe_info, column_info, data_sample, field_types),
+    ]
+    if field_types:
+        context.append(f"Use these Vega-Lite field types in every encoding:\n{describe_field_types(field_types)}")
+    # Static instructions first, then this dataset, then the turns: see prompt_layout.
+    messages = build_messages(instructions, context, conversation)
 
     try:
-        response = openai.chat.completions.create(
+        assistant_reply = speculative_chat_completion(
+            get_client(),
+            validate=is_vega_lite_spec,
             model="gpt-4o",
             messages=messages,
             temperature=0.3,
             max_tokens=2000,
+            stream=True,
+            **structured_request("vega_lite_spec", vega_lite_schema(column_info)),
         )
-        assistant_reply = response.choices[0].message.content
         return assistant_reply
     except Exception as e:
         raise ConnectionError(f"Error communicating with OpenAI: {e}")
@@ -108,10 +113,12 @@ def initialize_html(html_file="output-vega-lite-dashboard.html"):
             )
 
 
+@timed("append_json_to_html")
 def append_json_to_html(json_data, data, html_file="output-vega-lite-dashboard.html"):
     initialize_html(html_file)
     visualization_id = f"vis_{int(time.time() * 1000)}"
-    json_data["data"] = {"values": data}
+    # A copy, so the spec the caller keeps in the conversation doesn't carry every data row.
+    json_data = dict(json_data, data={"values": data})
     visualization_html = f"""
     <div class="visualization">
         <div id="{visualization_id}"></div>
@@ -131,8 +138,7 @@ def append_json_to_html(json_data, data, html_file="output-vega-lite-dashboard.h
     new_content = (
         content[:insertion_point] + visualization_html + content[insertion_point:]
     )
-    with open(html_file, "w") as f:
-        f.write(new_content)
+    write_output(html_file, new_content)
 
 
 def main():
@@ -144,39 +150,61 @@ def main():
 
     openai.api_key = api_key
 
-    csv_path = input("Enter the path to your CSV file: ").strip()
+    csv_path = input("Enter the path to your CSV file (or a directory or glob of CSV files): ").strip()
     try:
-        df = read_csv(csv_path)
-        print("\nCSV file successfully uploaded and read!")
+        df_future = read_csv_in_background(csv_path, optimize=True)
+        if should_sniff(csv_path):
+            # Large file: prompt from a sample while the full load finishes in the background.
+            sample, estimated_rows = sniff_csv(csv_path)
+            columns = sample.columns.tolist()
+            profile = cached_profile(csv_path, optimize=True)
+            if profile:
+                description = profile[0]
+            else:
+                description = summarize_sample(sample, estimated_rows)
+            print(
+                f"\nSampled {len(sample)} of ~{estimated_rows} rows; "
+                "loading the rest in the background."
+            )
+        else:
+            sample = df_future.result()
+            description, columns = dataset_profile(csv_path, sample, optimize=True)
+            print("\nCSV file successfully uploaded and read!")
     except ValueError as ve:
         print(ve)
         return
 
-    description, columns = infer_csv_structure(df)
     print("\n--- DataFrame Summary ---")
     print(pd.DataFrame(description).transpose())
     conversation = []
 
     print("\nStart chatting with the assistant. Type 'exit' or 'quit' to end the session.\n")
     initialize_html()
-    data_as_json = df.to_dict(orient="records")
-    data_sample = df.head(5).to_dict(orient="records")
+    data_as_json = None  # built once the full load has finished
+    data_sample = dataframe_to_records(sample.head(5))
+    field_types = detect_field_types(sample)
 
     while True:
         user_input = input("You: ").strip()
+        turn_start = time.perf_counter()
         if user_input.lower() in ["exit", "quit"]:
             print("Ending the chat. Goodbye!")
+            print_cache_stats()
+            print_spec_cache_stats()
+            print_speculative_stats()
             break
         if user_input:
             conversation.append({"role": "user", "content": user_input})
+        local = local_spec(user_input, field_types, select_template)
+        cached_spec = json.dumps(local) if local else lookup_spec(SPEC_NAMESPACE, columns, user_input, conversation[:-1])
         try:
-            assistant_reply = send_message_to_openai(
-                conversation, description, columns, data_sample
+            assistant_reply = cached_spec or send_message_to_openai(
+                conversation, description, columns, data_sample, field_types
             )
         except ConnectionError as ce:
             print(ce)
             continue
-        extracted_json = extract_json(assistant_reply)
+        extracted_json = reply_json(assistant_reply)
         if extracted_json and isinstance(extracted_json, str):
             extracted_json = json.loads(extracted_json)
         if extracted_json:
@@ -191,10 +219,18 @@ def main():
                 conversation.append({"role": "assistant", "content": json.dumps(extracted_json)})
                 continue
             try:
-                template_copy = copy.deepcopy(template)
-                template_copy = deep_merge_dicts(extracted_json, template_copy)
+                if local:
+                    template_copy = local  # already built on the template
+                else:
+                    template_copy = copy.deepcopy(template)
+                    template_copy = deep_merge_dicts(extracted_json, template_copy)
+                apply_field_types(template_copy, field_types)
                 print(json.dumps(template_copy, indent=2))
+                if data_as_json is None:
+                    data_as_json = dataframe_to_records(df_future.result())
                 append_json_to_html(template_copy, data_as_json)
+                TIME_TO_CHART_SECONDS.labels(entry_point="vega-lite-dashboard-json").observe(time.perf_counter() - turn_start)
+                store_spec(SPEC_NAMESPACE, columns, user_input, json.dumps(extracted_json), conversation[:-1])
                 conversation.append({"role": "assistant", "content": json.dumps(template_copy)})
                 print(f"\nVisualization appended to 'output-vega-lite-dashboard.html'.")
             except json.JSONDecodeError as jde: